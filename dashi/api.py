@@ -1,19 +1,136 @@
+import datetime
+import hashlib
+import threading
+
 import flask
 
 import pygal
 
+import dashi.db
+import dashi.time
+import dashi.timestamp
+
 blueprint = flask.Blueprint('api', __name__)
 
+DEFAULT_WEEKS = 12
+MAX_WEEKS = 260
+
+_LOCAL = threading.local()
+
+class ChartCache():
+    """
+    Rendered charts kept in memory. Entries are keyed by the chart, its
+    arguments and the database's data version so a load() makes every
+    chart stale at once. Only the current version is kept
+    """
+    def __init__(self):
+        self.version = None
+        self.charts = {}
+        self.lock = threading.Lock()
+
+    def get(self, version, key):
+        with self.lock:
+            if version != self.version:
+                return None
+            return self.charts.get(key)
+
+    def put(self, version, key, chart):
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.charts = {}
+            self.charts[key] = chart
+
+CHARTS = ChartCache()
+
+def _connection():
+    """
+    One connection per thread, sqlite connections can't be shared between
+    them. The tables are created if need be so a database load() hasn't
+    filled yet gives empty charts instead of errors
+    """
+    if not hasattr(_LOCAL, 'connection'):
+        _LOCAL.connection = dashi.db.connection()
+        dashi.db.create_tables(_LOCAL.connection)
+    return _LOCAL.connection
+
+def _weeks():
+    try:
+        weeks = int(flask.request.args.get('weeks', DEFAULT_WEEKS))
+    except ValueError:
+        flask.abort(400)
+    return max(1, min(weeks, MAX_WEEKS))
+
+def _periods(weeks):
+    return dashi.time.checkpoints_since(datetime.datetime.utcnow() - datetime.timedelta(weeks=weeks - 1))
+
+def _labels(periods):
+    return [start.date().isoformat() for start, _ in periods]
+
+def _svg_response(name, render, weeks):
+    """
+    Serve a chart from the cache, rendering it only if the data, the number
+    of weeks or the week they start from have changed since it was last
+    asked for. The ETag lets browsers revalidate without getting the chart again
+    """
+    connection = _connection()
+    version = dashi.db.get_data_version(connection)
+    key = (name, weeks, _periods(weeks)[0][0].date())
+    chart = CHARTS.get(version, key)
+    if chart is None:
+        svg = render(connection, weeks)
+        etag = hashlib.sha1(svg).hexdigest()
+        chart = (svg, etag)
+        CHARTS.put(version, key, chart)
+    svg, etag = chart
+    response = flask.Response(response=svg, content_type='image/svg+xml')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(flask.request)
+
+def _render_user_matrix(title, matrix, periods):
+    chart = pygal.StackedBar(width=800, height=400, x_label_rotation=30)
+    chart.title = title
+    chart.x_labels = _labels(periods)
+    config = flask.current_app.config['DASHI']
+    for user, counts in zip(config['users'], matrix['users']):
+        chart.add(user.name, counts)
+    chart.add('Other', [total - sum(counts) for total, *counts in zip(matrix['total'], *matrix['users'])])
+    return chart.render()
+
+def _render_commits(connection, weeks):
+    periods = _periods(weeks)
+    config = flask.current_app.config['DASHI']
+    matrix = dashi.db.get_commit_count_matrix(connection, periods, config['users'], config['aliases'])
+    return _render_user_matrix('Commits per week', matrix, periods)
+
+def _render_resolutions(connection, weeks):
+    periods = _periods(weeks)
+    config = flask.current_app.config['DASHI']
+    matrix = dashi.db.get_resolution_count_matrix(connection, periods, config['users'], config['aliases'])
+    return _render_user_matrix('Sentry issues resolved per week', matrix, periods)
+
+def _render_tests(connection, weeks):
+    periods = _periods(weeks)
+    counts = dashi.db.get_test_counts(connection, periods[0][0], periods[-1][1])
+    chart = pygal.DateTimeLine(width=800, height=400, x_label_rotation=30, x_value_formatter=lambda value: value.date().isoformat())
+    chart.title = 'Tests per build'
+    for job, builds in sorted(counts.items()):
+        chart.add(job, [(dashi.timestamp.parse(date), tests) for date, tests in builds])
+    return chart.render()
+
 @blueprint.route('/')
 def index():
     return flask.render_template('index.html')
 
-@blueprint.route('/barchart/')
-def forecast():
-    bar_chart = pygal.Bar(width=500, height=400)
-    bar_chart.title = 'Eli'
-    lower, higher, params = [12, 13], [15, 18], ['param1', 'param2']
-    bar_chart.add('lower', lower)
-    bar_chart.add('higher', higher)
-    bar_chart.x_labels = params
-    return flask.Response(response=bar_chart.render(), content_type='image/svg+xml')
+@blueprint.route('/charts/commits.svg')
+def commits_chart():
+    return _svg_response('commits', _render_commits, _weeks())
+
+@blueprint.route('/charts/tests.svg')
+def tests_chart():
+    return _svg_response('tests', _render_tests, _weeks())
+
+@blueprint.route('/charts/resolutions.svg')
+def resolutions_chart():
+    return _svg_response('resolutions', _render_resolutions, _weeks())
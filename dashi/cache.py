@@ -0,0 +1,78 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import dashi.json
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TTL = 60 * 60
+DEFAULT_ARCHIVE_TTL = 7 * 24 * 60 * 60
+# Late pushes, resolutions and builds keep arriving for a while after a week ends
+DEFAULT_SETTLE = 7 * 24 * 60 * 60
+DEFAULT_JENKINS_TTL = 15 * 60
+
+# The parts of the configuration that change what each source collects
+SOURCE_SECTIONS = {
+    'git'       : ('repositories', 'git'),
+    'jenkins'   : ('jenkins',),
+    'jira'      : ('jira',),
+    'sentry'    : ('sentry',),
+}
+
+def config_hash(config, source):
+    relevant = {
+        'users'     : [(user.name, user.aliases, user.config.get('jirakey')) for user in config['users']],
+        'sections'  : [config.get(section) for section in SOURCE_SECTIONS[source]],
+    }
+    encoded = json.dumps(relevant, sort_keys=True, default=lambda obj: obj.config)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()[:12]
+
+class SourceCache():
+    """
+    The collected data for each source and week, stored separately so that
+    one source expiring doesn't mean collecting all of them again. Weeks that
+    haven't ended or ended less than settle seconds ago expire after ttl so
+    late data gets picked up, older weeks are kept for archive_ttl. Jenkins
+    reports the latest build rather than the week's, so it expires after
+    jenkins_ttl whatever the week
+    """
+    def __init__(self, config):
+        options          = config.get('context_cache', {})
+        self.config      = config
+        self.path        = options.get('path', os.path.join(os.environ['HOME'], '.dashi', 'sources'))
+        self.ttl         = options.get('ttl', DEFAULT_TTL)
+        self.archive_ttl = options.get('archive_ttl', DEFAULT_ARCHIVE_TTL)
+        self.settle      = options.get('settle', DEFAULT_SETTLE)
+        self.jenkins_ttl = options.get('jenkins_ttl', DEFAULT_JENKINS_TTL)
+
+    def _entry_path(self, source, start, end):
+        filename = '{}_{}_{}.json'.format(start.date().isoformat(), end.date().isoformat(), config_hash(self.config, source))
+        return os.path.join(self.path, source, filename)
+
+    def _ttl(self, source, end):
+        if source == 'jenkins':
+            return self.jenkins_ttl
+        return self.ttl if time.time() - end.timestamp() < self.settle else self.archive_ttl
+
+    def load(self, source, start, end):
+        path = self._entry_path(source, start, end)
+        try:
+            with open(path, 'r') as f:
+                entry = dashi.json.load_tagged(f, self.config['users'])
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            LOGGER.warning("Ignoring unreadable cached %s data at %s: %s", source, path, e)
+            return None
+        if time.time() - entry['stored'] > self._ttl(source, end):
+            LOGGER.debug("Cached %s data for %s has expired", source, start.date())
+            return None
+        return entry['value']
+
+    def store(self, source, start, end, value):
+        path = self._entry_path(source, start, end)
+        with dashi.json.atomic_write(path) as f:
+            dashi.json.dump_tagged({'stored': time.time(), 'value': value}, f)
@@ -0,0 +1,129 @@
+import datetime
+import json
+import logging
+import os
+
+import dashi.json
+import dashi.time
+import dashi.timestamp
+
+LOGGER = logging.getLogger(__name__)
+
+# Kept beyond the lookback so a caller asking for the same start a little later is still covered
+TRIM_MARGIN = datetime.timedelta(days=1)
+
+def index_path(config, repository, purpose=None):
+    """
+    Where the index for repository lives. Indexes with a purpose are kept
+    apart from the default one so that, say, a backfill reaching a year
+    back doesn't make every weekly run load all of that year
+    """
+    root = config.get('paths', {}).get('commits', os.path.join(os.environ['HOME'], '.dashi', 'commits'))
+    name = repository.name if purpose is None else '{}.{}'.format(repository.name, purpose)
+    return os.path.join(root, '{}.json'.format(name))
+
+def load(config, repository, purpose=None):
+    return CommitIndex.load(index_path(config, repository, purpose))
+
+def _dump_commit(commit):
+    dumped = dict(commit)
+    dumped['datetime'] = commit['datetime'].isoformat()
+    return dumped
+
+def _load_commit(commit):
+    commit['datetime'] = dashi.timestamp.parse(commit['datetime'])
+    return commit
+
+class CommitIndex():
+    """
+    The commits we have already seen for a single repository along with the
+    tip of each ref at the time. Commits never change once made so later runs
+    only need to ask git for what is reachable from the current refs but not
+    from the refs recorded here. When history is rewritten prune() drops the
+    commits nothing reaches any more. The index only keeps as much history
+    as the furthest any caller has looked back, so it grows with the
+    commits in that window rather than with every commit since the first run
+    """
+    def __init__(self, path, since=None, refs=None, commits=None, lookback=None):
+        self.path     = path
+        self.since    = since
+        self.refs     = refs or {}
+        self.commits  = commits or []
+        self.lookback = lookback
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls(path)
+        except ValueError as e:
+            LOGGER.warning("Ignoring unreadable commit index at %s: %s", path, e)
+            return cls(path)
+        return cls(
+            path,
+            since   = dashi.timestamp.parse(data['since']),
+            refs    = data['refs'],
+            commits = [_load_commit(commit) for commit in data['commits']],
+            lookback = datetime.timedelta(seconds=data['lookback']) if data.get('lookback') is not None else None,
+        )
+
+    def save(self):
+        if self.lookback is not None:
+            self.trim(dashi.time.utcnow() - self.lookback - TRIM_MARGIN)
+        with dashi.json.atomic_write(self.path) as f:
+            json.dump({
+                'since'     : self.since.isoformat(),
+                'refs'      : self.refs,
+                'commits'   : [_dump_commit(commit) for commit in self.commits],
+                'lookback'  : self.lookback.total_seconds() if self.lookback is not None else None,
+            }, f)
+        LOGGER.debug("Saved %d commits to %s", len(self.commits), self.path)
+
+    def covers(self, start):
+        return self.since is not None and self.since <= start
+
+    def look_back_to(self, start):
+        "Note that a caller wants commits from start on, widening the lookback save() trims to"
+        lookback = dashi.time.utcnow() - start
+        if self.lookback is None or lookback > self.lookback:
+            self.lookback = lookback
+
+    def trim(self, since):
+        "Drop the commits from before since and stop covering that time"
+        if self.since is None or since <= self.since:
+            return
+        self.since = since
+        self.commits = [commit for commit in self.commits if commit['datetime'] >= since]
+
+    def reset(self, since):
+        self.since   = since
+        self.refs    = {}
+        self.commits = []
+
+    def merge(self, commits, refs):
+        known = {commit['hash'] for commit in self.commits}
+        added = [commit for commit in commits if commit['hash'] not in known]
+        self.commits = sorted(self.commits + added, key=lambda commit: commit['datetime'])
+        self.refs = refs
+        return added
+
+    def prune(self, reachable):
+        """
+        Drop the commits whose hash isn't in reachable, a set of full hashes.
+        Ours are abbreviated so they are compared against prefixes of the
+        same length. Returns the commits that were dropped
+        """
+        prefixes = {}
+        for commit in self.commits:
+            length = len(commit['hash'])
+            if length not in prefixes:
+                prefixes[length] = {sha[:length] for sha in reachable}
+        kept = [commit for commit in self.commits if commit['hash'] in prefixes[len(commit['hash'])]]
+        removed = [commit for commit in self.commits if commit['hash'] not in prefixes[len(commit['hash'])]]
+        self.commits = kept
+        return removed
+
+    def between(self, start, end=None):
+        return [commit for commit in self.commits if commit['datetime'] > start and (end is None or end > commit['datetime'])]
@@ -0,0 +1,77 @@
+import numpy
+
+def _intern(values):
+    "Turn a list of strings into the distinct strings and an array of codes into them"
+    names = {}
+    codes = numpy.fromiter((names.setdefault(value, len(names)) for value in values), dtype=numpy.int32, count=len(values))
+    return list(names), codes
+
+class CommitTable():
+    """
+    Commits held column by column and sorted by time. Windows are found by
+    binary search on the timestamps and per-user totals are computed over
+    whole columns at once instead of looping over dicts
+    """
+    def __init__(self, commits):
+        timestamps = numpy.fromiter((commit['datetime'].timestamp() for commit in commits), dtype=numpy.int64, count=len(commits))
+        order = numpy.argsort(timestamps, kind='mergesort')
+        self.timestamps = timestamps[order]
+        self.authors, author_codes = _intern([commit['author'] for commit in commits])
+        self.author_codes = author_codes[order]
+        self.repositories, repository_codes = _intern([commit['repo'] for commit in commits])
+        self.repository_codes = repository_codes[order]
+        self.files   = numpy.array([commit['files'] for commit in commits], dtype=numpy.int32)[order]
+        self.inserts = numpy.array([commit['inserts'] for commit in commits], dtype=numpy.int32)[order]
+        self.deletes = numpy.array([commit['deletes'] for commit in commits], dtype=numpy.int32)[order]
+        self.hashes  = [commits[index]['hash'] for index in order]
+        # Kept as they came so each commit still shows its author's own UTC offset
+        self.datetimes = [commits[index]['datetime'] for index in order]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def window(self, start, end):
+        "The slice of commits strictly between start and end, like dashi.git.commits_between"
+        low = numpy.searchsorted(self.timestamps, start.timestamp(), side='right')
+        high = numpy.searchsorted(self.timestamps, end.timestamp(), side='left')
+        return slice(int(low), int(max(low, high)))
+
+    def user_codes(self, users, aliases):
+        "For each author code the index of its user in users, or -1 when it isn't one of them"
+        positions = {user: index for index, user in enumerate(users)}
+        codes = [positions.get(aliases.get(author), -1) for author in self.authors]
+        return numpy.array(codes, dtype=numpy.int32)
+
+    def count_matrix(self, periods, users, aliases):
+        "The same shape dashi.db.get_commit_count_matrix returns, computed in memory"
+        codes = self.user_codes(users, aliases)
+        total = []
+        counts = numpy.zeros((len(users), len(periods)), dtype=numpy.int64)
+        for index, (start, end) in enumerate(periods):
+            window = self.window(start, end)
+            total.append(window.stop - window.start)
+            owners = codes[self.author_codes[window]]
+            owners = owners[owners >= 0]
+            counts[:, index] = numpy.bincount(owners, minlength=len(users))
+        return {
+            'periods'   : periods,
+            'total'     : total,
+            'users'     : counts.tolist(),
+        }
+
+    def indices_for(self, user, aliases, start=None, end=None):
+        window = self.window(start, end) if start is not None else slice(0, len(self))
+        codes = self.user_codes([user], aliases)
+        mine = numpy.nonzero(codes[self.author_codes[window]] == 0)[0]
+        return mine + window.start
+
+    def record(self, index):
+        return {
+            'author'    : self.authors[self.author_codes[index]],
+            'datetime'  : self.datetimes[index],
+            'hash'      : self.hashes[index],
+            'files'     : int(self.files[index]),
+            'inserts'   : int(self.inserts[index]),
+            'deletes'   : int(self.deletes[index]),
+            'repo'      : self.repositories[self.repository_codes[index]],
+        }
@@ -1,5 +1,6 @@
 import logging
 import os
+import types
 
 import yaml
 
@@ -9,10 +10,7 @@ class User():
     def __init__(self, name, config):
         self.name = name
         self.config = config
-
-    @property
-    def aliases(self):
-        return [self.email] + self.config.get('aliases', [])
+        self.aliases = tuple([self.email] + self.config.get('aliases', []))
 
     @property
     def email(self):
@@ -53,9 +51,25 @@ def parse():
 
     config['users'] = [User(name, c) for name, c in config['users'].items()]
     config['repositories'] = [Repository(name, c) for name, c in config['repositories'].items()]
+    config['aliases'] = alias_index(config['users'])
 
     return config
 
+def alias_index(users):
+    """
+    Map every alias of every user back to that user so that attributing an
+    author is a single lookup instead of a scan of everyone's aliases
+    """
+    index = {}
+    for user in users:
+        for alias in user.aliases:
+            if alias in index and index[alias] is not user:
+                LOGGER.warning("Alias %s is used by both %s and %s, attributing it to %s",
+                    alias, index[alias].name, user.name, index[alias].name)
+                continue
+            index[alias] = user
+    return types.MappingProxyType(index)
+
 def get_user(config, username):
     matches = []
     for user in config['users']:
@@ -1,60 +1,138 @@
+import datetime
 import logging
-import os
 import sqlite3
 
 import asyncio
+import dashi.commitindex
 import dashi.config
 import dashi.git
 import dashi.jenkins
+import dashi.sentry
+import dashi.time
 
 LOGGER = logging.getLogger(__name__)
 
+SCHEMA_VERSION = 2
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=dashi.time.UTC())
+WEEK = datetime.timedelta(days=7)
+
 def connection():
-    return sqlite3.connect('dashi.db')
+    conn = sqlite3.connect('dashi.db')
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+def to_db_date(value):
+    """
+    Dates are stored as UTC in one fixed format so that they compare
+    correctly as plain strings and the date indexes can be used
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=dashi.time.UTC())
+    return value.astimezone(dashi.time.UTC()).strftime('%Y-%m-%d %H:%M:%S')
+
+def from_db_date(value):
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=dashi.time.UTC())
 
 @asyncio.coroutine
 def load():
     config = dashi.config.parse()
 
-    if os.path.exists('dashi.db'):
-        os.remove('dashi.db')
-
     conn = connection()
 
-    _create_tables(conn)
+    create_tables(conn)
     yield from _load_commits(conn, config)
-    #yield from _load_jenkins(conn, config)
+    yield from _load_jenkins(conn, config)
+    yield from _load_sentry(conn, config)
+    bump_data_version(conn)
+
+class _DatabaseIndex(dashi.commitindex.CommitIndex):
+    """
+    The commits already in the commits table for one repository. Like
+    jenkins_sync the refs they were loaded from are kept in the database
+    as well, so whatever happens to dashi.db the two can't disagree and
+    only what changed since the last load has to be written
+    """
+    def __init__(self, connection, repository):
+        commits = [{
+            'hash'      : sha,
+            'datetime'  : from_db_date(date),
+            'repo'      : repository.name,
+        } for sha, date in connection.execute("SELECT hash, date FROM commits WHERE repository = ?", (repository.name,))]
+        refs = connection.execute("SELECT ref, sha FROM commits_sync WHERE repository = ?", (repository.name,))
+        # Without any rows the refs can't stand for anything, start from the whole history again
+        super().__init__(None, since=EPOCH, refs=dict(refs) if commits else {}, commits=commits)
+        self.connection = connection
+        self.repository = repository
+
+    def save(self):
+        "Record the refs in the same transaction as the rows they go with"
+        self.connection.execute("DELETE FROM commits_sync WHERE repository = ?", (self.repository.name,))
+        self.connection.executemany("INSERT INTO commits_sync (repository, ref, sha) VALUES (?, ?, ?)",
+            [(self.repository.name, ref, sha) for ref, sha in sorted(self.refs.items())])
 
 @asyncio.coroutine
 def _load_commits(connection, config):
     cursor = connection.cursor()
     for repo in config['repositories']:
-        commits = yield from dashi.git.get_commits(config, repo)
+        index = _DatabaseIndex(connection, repo)
+        added, removed = yield from dashi.git.update_index(repo, index, EPOCH)
         simplified = [(
-            commit['date'],
+            to_db_date(commit['datetime']),
             commit['hash'],
-            commit['author']['user']['display_name'] if 'user' in commit['author'] else commit['author']['raw'],
-            commit['repository']['name'])
-        for commit in commits]
-        cursor.executemany("INSERT INTO commits (date, hash, author, repository, lines) VALUES (?,?,?,?)", simplified)
+            commit['author'],
+            commit['repo'],
+            commit['inserts'] + commit['deletes'],
+        ) for commit in added]
+        cursor.executemany("""INSERT INTO commits (date, hash, author, repository, lines) VALUES (?,?,?,?,?)
+            ON CONFLICT (repository, hash) DO UPDATE SET date = excluded.date, author = excluded.author, lines = excluded.lines""",
+            simplified)
+        cursor.executemany("DELETE FROM commits WHERE repository = ? AND hash = ?",
+            [(repo.name, commit['hash']) for commit in removed])
         connection.commit()
-        LOGGER.debug("Inserted %s rows into commits for %s", len(simplified), repo)
+        LOGGER.debug("Upserted %s and deleted %s rows in commits for %s", len(simplified), len(removed), repo.name)
 
 @asyncio.coroutine
 def _load_jenkins(connection, config):
     cursor = connection.cursor()
-    server = dashi.jenkins.connect(config)
-    for repo in config['repositories']:
-        results = dashi.jenkins.get_test_results_for_repo(server, repo)
+    session = dashi.jenkins.create_session(config)
+    for job in config['jenkins']['jobs']:
+        row = cursor.execute("SELECT build FROM jenkins_sync WHERE job = ?", (job,)).fetchone()
+        after = row[0] if row else 0
+        results, synced = dashi.jenkins.get_test_history(config, session, job, after)
         simplified = [(
             result['name'],
             result['build'],
-            result['date'],
-            len(result['tests']),
+            to_db_date(result['date']),
+            result['tests'],
         ) for result in results]
-        cursor.executemany("INSERT INTO tests (name, build, date, tests) VALUES (?, ?, ?, ?)", simplified)
+        cursor.executemany("INSERT OR REPLACE INTO tests (name, build, date, tests) VALUES (?, ?, ?, ?)", simplified)
+        cursor.execute("INSERT OR REPLACE INTO jenkins_sync (job, build) VALUES (?, ?)", (job, synced))
         connection.commit()
-        LOGGER.debug("Inserted %s rows into tests for %s", len(simplified), repo['name'])
+        LOGGER.debug("Inserted %s rows into tests for %s", len(simplified), job)
+
+@asyncio.coroutine
+def _load_sentry(connection, config):
+    cursor = connection.cursor()
+    resolutions = dashi.sentry.get_resolutions(config)
+    simplified = [(
+        resolution['id'],
+        resolution['project'],
+        to_db_date(resolution['date']),
+        resolution['resolver'],
+    ) for resolution in resolutions]
+    cursor.executemany("INSERT OR REPLACE INTO resolutions (issue, project, date, resolver) VALUES (?, ?, ?, ?)", simplified)
+    connection.commit()
+    LOGGER.debug("Inserted %s rows into resolutions", len(simplified))
+
+def get_data_version(connection):
+    "A number that changes whenever load() changes what is in the database"
+    row = connection.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()
+    return row[0] if row else 0
+
+def bump_data_version(connection):
+    connection.execute("""INSERT INTO meta (key, value) VALUES ('data_version', 1)
+        ON CONFLICT (key) DO UPDATE SET value = value + 1""")
+    connection.commit()
 
 def get_all_authors(connection):
     cursor = connection.cursor()
@@ -62,37 +140,115 @@ def get_all_authors(connection):
     return [r[0] for r in result]
 
 def get_commit_counts_by_time_periods(connection, periods, user):
+    counts = get_commit_count_matrix(connection, periods, [user], dashi.config.alias_index([user]))
     return [{
         'start' : period[0],
         'end'   : period[1],
-        'total' : _total_commits(connection, period[0], period[1]),
-        'mine'  : _commits_for(connection, period[0], period[1], user),
-    } for period in periods]
+        'total' : total,
+        'mine'  : mine,
+    } for period, total, mine in zip(periods, counts['total'], counts['users'][0])]
 
-def _total_commits(connection, start, end):
-    cursor = connection.cursor()
-    result = cursor.execute(
-        "SELECT hash FROM commits WHERE datetime(date) > datetime(?) AND datetime(date) < (?)",
-        (start.isoformat(), end.isoformat())
+def get_commit_count_matrix(connection, periods, users, aliases):
+    """
+    Count commits per period for every user. Consecutive weeks like the
+    ones dashi.time.checkpoints_since produces are counted in one grouped
+    query, any other periods take a query each. Returns the total for each
+    period and a row of counts per user in the same order as users. Commits
+    from unknown authors only count towards the totals
+    """
+    return _count_matrix(connection, 'commits', 'author', periods, users, aliases)
+
+def get_resolution_count_matrix(connection, periods, users, aliases):
+    "Like get_commit_count_matrix for Sentry issues resolved each week"
+    return _count_matrix(connection, 'resolutions', 'resolver', periods, users, aliases)
+
+def _are_consecutive_weeks(periods):
+    return all(end - start == WEEK for start, end in periods) and all(
+        previous[1] == current[0] for previous, current in zip(periods, periods[1:]))
+
+# Dates are stored to the second and periods from dashi.time.get_checkpoint
+# start a microsecond after midnight, so a period is counted as everything
+# after its start's second up to and including its end's. A row at exactly
+# midnight on a Monday then falls in the week that ends there, just like
+# dashi.git.commits_between puts it
+
+def _weekly_counts(connection, table, person, periods):
+    "(period index, person, count) rows for consecutive weeks from one grouped query"
+    start = periods[0][0]
+    end = periods[-1][1]
+    return connection.execute(
+        """SELECT (CAST(strftime('%s', date) AS INTEGER) - ? - 1) / ? AS week, {person}, COUNT(*)
+        FROM {table} WHERE date > ? AND date <= ? GROUP BY week, {person}""".format(table=table, person=person),
+        (int(start.timestamp()), int(WEEK.total_seconds()), to_db_date(start), to_db_date(end))
     )
-    return len(result.fetchall())
 
-def _as_list(l):
-    items = ["'{}'".format(i) for i in l]
-    return "({})".format(','.join(items))
+def _period_counts(connection, table, person, periods):
+    "(period index, person, count) rows for any periods, one query per period"
+    for index, (start, end) in enumerate(periods):
+        result = connection.execute(
+            "SELECT {person}, COUNT(*) FROM {table} WHERE date > ? AND date <= ? GROUP BY {person}".format(table=table, person=person),
+            (to_db_date(start), to_db_date(end)))
+        for name, count in result:
+            yield index, name, count
 
-def _commits_for(connection, start, end, user):
+def _count_matrix(connection, table, person, periods, users, aliases):
+    if not periods:
+        return {'periods': periods, 'total': [], 'users': [[] for _ in users]}
+    if _are_consecutive_weeks(periods):
+        result = _weekly_counts(connection, table, person, periods)
+    else:
+        result = _period_counts(connection, table, person, periods)
+    rows = {user: index for index, user in enumerate(users)}
+    total = [0] * len(periods)
+    counts = [[0] * len(periods) for _ in users]
+    for week, author, count in result:
+        total[week] += count
+        user = aliases.get(author)
+        if user in rows:
+            counts[rows[user]][week] += count
+    return {
+        'periods'   : periods,
+        'total'     : total,
+        'users'     : counts,
+    }
+
+def get_test_counts(connection, start, end):
+    "The test count of every build of every job between start and end as {job: [(date, tests)]} in date order"
     cursor = connection.cursor()
     result = cursor.execute(
-        "SELECT hash FROM commits WHERE datetime(date) > datetime(?) AND datetime(date) < (?) AND author IN {}".format(_as_list(user.aliases)),
-        (start.isoformat(), end.isoformat())
-    )
-    return len(result.fetchall())
+        "SELECT name, date, tests FROM tests WHERE date > ? AND date < ? ORDER BY name, date",
+        (to_db_date(start), to_db_date(end)))
+    counts = {}
+    for name, date, tests in result:
+        counts.setdefault(name, []).append((date, tests))
+    return counts
 
-def _create_tables(conn):
+def create_tables(conn):
     c = conn.cursor()
-    c.execute("""CREATE TABLE commits
-        (date TEXT, hash TEXT, author TEXT, repository TEXT, lines NUMBER)""")
-    c.execute("""CREATE TABLE tests
-        (name TEXT, build NUMBER, date TEXT, tests NUMBER)""")
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        # Older databases were thrown away on every load and had no keys, start them over
+        LOGGER.info("Upgrading database schema from version %s to %s", version, SCHEMA_VERSION)
+        for table in ('commits', 'commits_sync', 'tests', 'jenkins_sync'):
+            c.execute("DROP TABLE IF EXISTS {}".format(table))
+    c.execute("""CREATE TABLE IF NOT EXISTS commits
+        (date TEXT NOT NULL, hash TEXT NOT NULL, author TEXT NOT NULL, repository TEXT NOT NULL, lines NUMBER,
+        UNIQUE (repository, hash))""")
+    c.execute("CREATE INDEX IF NOT EXISTS commits_date ON commits (date)")
+    c.execute("CREATE INDEX IF NOT EXISTS commits_author_date ON commits (author, date)")
+    c.execute("""CREATE TABLE IF NOT EXISTS tests
+        (name TEXT NOT NULL, build NUMBER NOT NULL, date TEXT, tests NUMBER,
+        UNIQUE (name, build))""")
+    c.execute("CREATE INDEX IF NOT EXISTS tests_date ON tests (date)")
+    c.execute("""CREATE TABLE IF NOT EXISTS jenkins_sync
+        (job TEXT PRIMARY KEY, build NUMBER)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS commits_sync
+        (repository TEXT NOT NULL, ref TEXT NOT NULL, sha TEXT NOT NULL,
+        UNIQUE (repository, ref))""")
+    c.execute("""CREATE TABLE IF NOT EXISTS resolutions
+        (issue TEXT PRIMARY KEY, project TEXT, date TEXT NOT NULL, resolver TEXT)""")
+    c.execute("CREATE INDEX IF NOT EXISTS resolutions_date ON resolutions (date)")
+    c.execute("""CREATE TABLE IF NOT EXISTS meta
+        (key TEXT PRIMARY KEY, value)""")
+    c.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
     conn.commit()
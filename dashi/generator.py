@@ -1,13 +1,20 @@
 import asyncio
+import concurrent.futures
 import datetime
+import hashlib
+import json
 import logging
 import os
-import pickle
+import time
 
 import jinja2
+import jinja2.meta
 
+import dashi.cache
 import dashi.config
 import dashi.db
+import dashi.git
+import dashi.httpcache
 import dashi.jenkins
 import dashi.jira
 import dashi.json
@@ -17,15 +24,58 @@ import dashi.upload
 
 LOGGER = logging.getLogger(__name__)
 
+SOURCES = ('git', 'jenkins', 'jira', 'sentry')
+# The fingerprint each rendered file was written from, one per output directory
+# so weeks rendered by different processes never write the same manifest
+RENDER_MANIFEST = '.dashi-render-manifest.json'
+# Parts of the context that get their own file when the export is split
+SPLIT_EXPORTS = ('commits', 'jenkins', 'jira', 'sentry')
+
+_TEMPLATE_ENVIRONMENTS = {}
+
+def template_environment(config):
+    """
+    The jinja environment for the configured template directory. There is
+    one per process so templates are only compiled once however many pages
+    or weeks get rendered, and the compiled bytecode is kept on disk so the
+    next run can skip compiling too. Jinja checks each template's source
+    against the cached bytecode so edits invalidate it automatically
+    """
+    searchpath = config['paths']['template']
+    if searchpath not in _TEMPLATE_ENVIRONMENTS:
+        bytecode_path = config['paths'].get('bytecode', os.path.join(os.environ['HOME'], '.dashi', 'bytecode'))
+        bytecode_cache = None
+        if bytecode_path:
+            os.makedirs(bytecode_path, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_path)
+        _TEMPLATE_ENVIRONMENTS[searchpath] = jinja2.Environment(
+            loader          = jinja2.FileSystemLoader(searchpath=searchpath),
+            bytecode_cache  = bytecode_cache,
+        )
+    return _TEMPLATE_ENVIRONMENTS[searchpath]
+
+def precompile_templates(config):
+    "Compile every template up front, filling the bytecode cache"
+    environment = template_environment(config)
+    for name in environment.list_templates(extensions=['html']):
+        environment.get_template(name)
+    return environment
+
 class Environment():
     def __init__(self, config, end):
         self.config               = config
         self.end                  = end
-        self.template_loader      = jinja2.FileSystemLoader(searchpath=self.config['paths']['template'])
-        self.template_environment = jinja2.Environment(loader=self.template_loader)
+        self.template_environment = template_environment(config)
+        self.template_loader      = self.template_environment.loader
 
         self.output_path = self.config['paths']['output']
         self.archive_path = self.end.date().isoformat()
+        self.manifests = {}
+        self._dependencies = {}
+
+        export = self.config.get('export', {})
+        self.split_export = export.get('split', False)
+        self.gzip_export = export.get('gzip', False)
 
     def setup_output(self):
         try:
@@ -34,43 +84,136 @@ class Environment():
         except OSError:
             pass
 
-    def write_file(self, templatename, context, path=None):
+    def _template_dependencies(self, templatename):
+        """
+        The source of a template and every template it extends or includes,
+        along with the context variables any of them use. Returns None for
+        the variables if a template is picked dynamically, in which case
+        we can't tell what it might use
+        """
+        if templatename not in self._dependencies:
+            source, _, _ = self.template_loader.get_source(self.template_environment, templatename)
+            ast = self.template_environment.parse(source)
+            sources = [source]
+            variables = set(jinja2.meta.find_undeclared_variables(ast))
+            for referenced in jinja2.meta.find_referenced_templates(ast):
+                if referenced is None:
+                    variables = None
+                    continue
+                parent_sources, parent_variables = self._template_dependencies(referenced)
+                sources += parent_sources
+                if variables is not None and parent_variables is not None:
+                    variables |= parent_variables
+                else:
+                    variables = None
+            self._dependencies[templatename] = (sources, variables)
+        return self._dependencies[templatename]
+
+    def _fingerprint(self, templatename, context):
+        sources, variables = self._template_dependencies(templatename)
+        used = context if variables is None else {name: context[name] for name in variables if name in context}
+        digest = hashlib.sha1()
+        for source in sources:
+            digest.update(source.encode('utf-8'))
+        digest.update(dashi.json.dumps(used, sort_keys=True))
+        return digest.hexdigest()
+
+    def _manifest(self, directory):
+        "The fingerprints of the files in one output directory, keyed by file name"
+        if directory not in self.manifests:
+            path = os.path.join(self.output_path, directory, RENDER_MANIFEST)
+            try:
+                with open(path, 'r') as f:
+                    self.manifests[directory] = json.load(f)
+            except FileNotFoundError:
+                self.manifests[directory] = {}
+            except ValueError as e:
+                LOGGER.warning("Ignoring unreadable render manifest %s: %s", path, e)
+                self.manifests[directory] = {}
+        return self.manifests[directory]
+
+    def _is_current(self, path, fingerprint):
+        directory, name = os.path.split(path)
+        return self._manifest(directory).get(name) == fingerprint and os.path.exists(os.path.join(self.output_path, path))
+
+    def _record(self, path, fingerprint):
+        directory, name = os.path.split(path)
+        self._manifest(directory)[name] = fingerprint
+
+    def write_file(self, templatename, context, path=None, normalised=None):
+        path = path or os.path.join(self.archive_path, templatename)
+        fingerprint = self._fingerprint(templatename, normalised if normalised is not None else dashi.json.normalise(context))
+        if self._is_current(path, fingerprint):
+            LOGGER.debug("Skipping %s, nothing it uses has changed", path)
+            return
+
         template = self.template_environment.get_template(templatename)
         output = template.render(**context)
 
-        path = path or os.path.join(self.archive_path, templatename)
-        path = os.path.join(self.output_path, path)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w') as f:
+        fullpath = os.path.join(self.output_path, path)
+        os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+        with open(fullpath, 'w') as f:
             f.write(output)
-            LOGGER.debug("Wrote %s", path)
+            LOGGER.debug("Wrote %s", fullpath)
+        self._record(path, fingerprint)
 
     def archives(self):
-        for f in os.listdir(self.output_path):
-            basename = os.path.basename(f)
-            if os.path.isdir(os.path.join(self.output_path, f)) and not basename.startswith('.'):
-                yield f
+        return sorted(entry.name for entry in os.scandir(self.output_path)
+            if entry.is_dir() and not entry.name.startswith('.'))
+
+    def _save_manifests(self):
+        for directory, manifest in self.manifests.items():
+            with dashi.json.atomic_write(os.path.join(self.output_path, directory, RENDER_MANIFEST)) as f:
+                json.dump(manifest, f, sort_keys=True, indent=2)
 
-    def write_files(self, context):
+    def write_files(self, context, root=True):
+        """
+        Render the current week and, unless root is False, the root page.
+        Each output is skipped when neither its templates nor the parts of
+        the context they use have changed since it was last written. Earlier
+        weeks are never touched so the cost doesn't grow with the archive
+        """
         context['path'] = "/{}/".format(self.end.date().isoformat())
 
-        context['archives'] = self.archives()
+        if root:
+            context['archives'] = self.archives()
+        # Converted to plain JSON values once for every fingerprint and the export
+        normalised = dashi.json.normalise(context)
         for templatepath, outputpath in self.output():
-            if templatepath:
-                self.write_file(templatepath, context, path=outputpath)
+            if templatepath and (root or outputpath.startswith(self.archive_path)):
+                self.write_file(templatepath, context, path=outputpath, normalised=normalised)
 
         # upload raw data
-        del context['archives']
-        path = os.path.join(self.output_path, self.archive_path, 'data.json')
-        with open(path, 'w') as f:
-            dashi.json.dump(context, f)
+        context.pop('archives', None)
+        normalised.pop('archives', None)
+        os.makedirs(os.path.join(self.output_path, self.archive_path), exist_ok=True)
+        for path, value in self._exports(normalised):
+            directory, name = os.path.split(path)
+            fingerprint, written = dashi.json.dump_file(value, os.path.join(self.output_path, path),
+                previous=self._manifest(directory).get(name), compress=self.gzip_export)
+            if written:
+                LOGGER.debug("Wrote %s", path)
+            self._record(path, fingerprint)
+        self._save_manifests()
+
+    def _exports(self, data):
+        "The data files and what goes in each. Split exports keep the small summary in data.json"
+        if not self.split_export:
+            yield os.path.join(self.archive_path, 'data.json'), data
+            return
+        yield os.path.join(self.archive_path, 'data.json'), {key: value for key, value in data.items() if key not in SPLIT_EXPORTS}
+        for key in SPLIT_EXPORTS:
+            yield os.path.join(self.archive_path, key + '.json'), data.get(key)
 
     def output(self):
         yield 'root.html', 'index.html'
         for template in ('index', 'commits', 'jenkins', 'jira', 'sentry'):
             templatename = template + '.html'
             yield templatename, os.path.join(self.archive_path, templatename)
-        yield None, os.path.join(self.archive_path, 'data.json')
+        for path, _ in self._exports({}):
+            yield None, path
+            if self.gzip_export:
+                yield None, path + '.gz'
 
 @asyncio.coroutine
 def update_data(config):
@@ -80,40 +223,63 @@ def update_data(config):
     LOGGER.info("Gathing data...")
 
 @asyncio.coroutine
-def get_context(config, args):
-    try:
-        with open(cache_path(), 'rb') as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        pass
-
+def _collect_git(config, args, start):
     if not args.no_update:
         yield from update_data(config)
-
-    start, end = dashi.time.get_checkpoint(datetime.datetime.utcnow() - datetime.timedelta(days=7))
     all_commits = yield from dashi.git.get_all_commits(config, start)
-    LOGGER.debug("%d commits", len(all_commits))
-
-    jenkins = dashi.jenkins.get_jenkins_stats(config)
+    LOGGER.debug("%d commits", sum([len(info['commits']) for info in all_commits.values()]))
+    return all_commits
 
-    jira = dashi.jira.get_statistics(config, start, end)
+@asyncio.coroutine
+def _collect(config, args, source, start, end):
+    # The HTTP based collectors are synchronous so they run on the default
+    # executor where they can't hold up the event loop or each other
+    loop = asyncio.get_event_loop()
+    if source == 'git':
+        return (yield from _collect_git(config, args, start))
+    elif source == 'jenkins':
+        return (yield from loop.run_in_executor(None, dashi.jenkins.get_jenkins_stats, config))
+    elif source == 'jira':
+        return (yield from loop.run_in_executor(None, dashi.jira.get_statistics, config, start, end))
+    elif source == 'sentry':
+        return (yield from loop.run_in_executor(None, dashi.sentry.get_statistics, config, start, end))
+    raise Exception("Unknown source {}".format(source))
 
-    sentry = dashi.sentry.get_statistics(config, start, end)
-    LOGGER.info("Gather complete")
+@asyncio.coroutine
+def _collect_and_store(config, args, cache, source, start, end):
+    began = time.time()
+    try:
+        value = yield from _collect(config, args, source, start, end)
+    except Exception: # pylint: disable=broad-except
+        LOGGER.exception("Failed to collect %s data after %.1f seconds, continuing without it", source, time.time() - began)
+        return {}
+    LOGGER.info("Collected %s data in %.1f seconds", source, time.time() - began)
+    cache.store(source, start, end, value)
+    return value
 
-    context = {
-        'commit_count'  : sum([len(info['commits']) for info in all_commits.values()]),
-        'commits'       : all_commits,
+def build_context(config, start, end, data):
+    return {
+        'commit_count'  : sum([len(info['commits']) for info in data['git'].values()]),
+        'commits'       : data['git'],
         'end'           : end,
-        'jenkins'       : jenkins,
-        'jira'          : jira,
-        'sentry'        : sentry,
+        'jenkins'       : data['jenkins'],
+        'jira'          : data['jira'],
+        'sentry'        : data['sentry'],
         'start'         : start,
         'users'         : config['users'],
     }
-    with open(cache_path(), 'wb') as f:
-        pickle.dump(context, f)
-    return context
+
+@asyncio.coroutine
+def get_context(config, args):
+    start, end = dashi.time.get_checkpoint(datetime.datetime.utcnow() - datetime.timedelta(days=7))
+    cache = dashi.cache.SourceCache(config)
+    data = {source: cache.load(source, start, end) for source in SOURCES}
+    missing = [source for source in SOURCES if data[source] is None]
+    LOGGER.info("Using cached data for %s, collecting %s", [source for source in SOURCES if source not in missing], missing)
+    results = yield from asyncio.gather(*[_collect_and_store(config, args, cache, source, start, end) for source in missing])
+    data.update(zip(missing, results))
+    LOGGER.info("Gather complete, HTTP cache %s", dashi.httpcache.get(config).stats())
+    return build_context(config, start, end, data)
 
 @asyncio.coroutine
 def go(config, args):
@@ -127,5 +293,75 @@ def go(config, args):
     if args.upload:
         dashi.upload.go(config, env)
 
-def cache_path():
-    return os.path.join(os.environ['HOME'], '.dashi', 'cache.pickle')
+@asyncio.coroutine
+def _collect_by_period(config, args, source, periods):
+    loop = asyncio.get_event_loop()
+    if source == 'git':
+        if not args.no_update:
+            yield from update_data(config)
+        return (yield from dashi.git.get_all_commits_by_period(config, periods))
+    elif source == 'jenkins':
+        return (yield from loop.run_in_executor(None, dashi.jenkins.get_jenkins_stats_by_period, config, periods))
+    elif source == 'jira':
+        return (yield from loop.run_in_executor(None, dashi.jira.get_statistics_by_period, config, periods))
+    elif source == 'sentry':
+        return (yield from loop.run_in_executor(None, dashi.sentry.get_statistics_by_period, config, periods))
+    raise Exception("Unknown source {}".format(source))
+
+@asyncio.coroutine
+def _collect_periods_and_store(config, args, cache, source, periods):
+    began = time.time()
+    try:
+        values = yield from _collect_by_period(config, args, source, periods)
+    except Exception: # pylint: disable=broad-except
+        LOGGER.exception("Failed to collect %s data after %.1f seconds, continuing without it", source, time.time() - began)
+        return [{} for _ in periods]
+    LOGGER.info("Collected %s data for %d weeks in %.1f seconds", source, len(periods), time.time() - began)
+    for (start, end), value in zip(periods, values):
+        cache.store(source, start, end, value)
+    return values
+
+def _render_config(config):
+    "The parts of the config Environment uses. Unlike the whole config they can be pickled for a worker process"
+    return {key: config[key] for key in ('paths', 'export') if key in config}
+
+def _render_week(config, context):
+    env = Environment(config, context['end'])
+    env.write_files(context, root=False)
+    return env.archive_path
+
+@asyncio.coroutine
+def backfill(config, args, since):
+    """
+    Build the archive of every week from the one containing since up to the
+    most recent finished week. Each source is collected once for the whole
+    range and split into weeks, then the weeks are rendered in parallel by a
+    pool of processes. The root page is written once at the end
+    """
+    now = dashi.time.utcnow()
+    periods = [(start, end) for start, end in dashi.time.checkpoints_since(since) if end <= now]
+    if not periods:
+        LOGGER.warning("No finished weeks since %s, nothing to backfill", since)
+        return
+    LOGGER.info("Backfilling %d weeks from %s to %s", len(periods), periods[0][0], periods[-1][1])
+
+    cache = dashi.cache.SourceCache(config)
+    results = yield from asyncio.gather(*[_collect_periods_and_store(config, args, cache, source, periods) for source in SOURCES])
+    LOGGER.info("Gather complete, HTTP cache %s", dashi.httpcache.get(config).stats())
+    contexts = [build_context(config, start, end, dict(zip(SOURCES, values)))
+        for (start, end), *values in zip(periods, *results)]
+
+    Environment(config, periods[-1][1]).setup_output()
+    precompile_templates(config)
+    loop = asyncio.get_event_loop()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as executor:
+        rendered = yield from asyncio.gather(*[
+            loop.run_in_executor(executor, _render_week, _render_config(config), context) for context in contexts])
+    LOGGER.info("Rendered %d weeks", len(rendered))
+
+    env = Environment(config, contexts[-1]['end'])
+    env.write_files(contexts[-1])
+
+    if args.upload:
+        for context in contexts:
+            dashi.upload.go(config, Environment(config, context['end']))
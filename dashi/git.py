@@ -1,17 +1,25 @@
 import asyncio
 import base64
+import bisect
+import codecs
 import json
 import logging
 import os
 import re
-import subprocess
+import time
 
 import aiohttp
-import dateutil
-import dateutil.parser
+
+import dashi.commitindex
+import dashi.httpcache
+import dashi.timestamp
 
 LOGGER = logging.getLogger(__name__)
 
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TIMEOUT = 300
+CHUNK_SIZE = 64 * 1024
+
 def repo(config, repoconfig):
     if repoconfig.host == 'bitbucket':
         return Bitbucket(config, repoconfig)
@@ -31,19 +39,36 @@ class Bitbucket(): # pylint: disable=too-few-public-methods
     def __init__(self, config, repoconfig):
         super().__init__(config, repoconfig)
         self.auth = (config['bitbucket']['username'], config['bitbucket']['password'])
+        self.cache = dashi.httpcache.get(config)
 
     @asyncio.coroutine
     def request(self, url):
+        key = self.cache.key('GET', url)
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.is_fresh(entry):
+            self.cache.record('hits')
+            return json.loads(entry['body'])
+
+        headers = basic_auth(*self.auth)
+        if entry is not None:
+            headers.update(self.cache.validators(entry))
         backoff = 1
         while backoff < 30:
-            response = yield from aiohttp.get(url, headers=basic_auth(*self.auth))
+            response = yield from aiohttp.get(url, headers=headers)
             text = yield from response.read()
             text = text.decode('utf-8')
             if response.status == 429:
                 LOGGER.debug("Being throttled GETing %s, waiting %s seconds", url, backoff)
                 yield from asyncio.sleep(backoff)
                 backoff = backoff * 1.5
+            elif response.status == 304 and entry is not None:
+                self.cache.record('revalidated')
+                entry['stored'] = time.time()
+                self.cache.put(key, entry)
+                return json.loads(entry['body'])
             elif response.status in (200, 201, 204):
+                self.cache.record('misses')
+                self.cache.put(key, dashi.httpcache.new_entry(url, response.status, response.headers, text))
                 return json.loads(text)
             else:
                 raise Exception("Failed to get commits at {}: {} {}".format(url, response.status, text))
@@ -65,93 +90,258 @@ def _add_stats(commit, line):
     commit['deletes'] = int(matches[2].group('deletes')) if matches[2] else 0
 
 
-def _parse_commits(output):
-    lines = output.split('\n')
-    commits = []
-    commit = {}
-    for line in lines:
-        if not line:
-            if commit:
-                commits.append(commit)
-                commit = {}
-        elif line.startswith(' '):
-            _add_stats(commit, line)
-        elif line.startswith('"') and line.endswith('"'):
-            if commit:
-                commits.append(commit)
-
-            line = line[1:-1]
-            _hash, _datetime, _author = line.split(' ')
-            commit = {
-                'author'    : _author,
-                'datetime'  : dateutil.parser.parse(_datetime),
-                'hash'      : _hash,
-                'files'     : 0,
-                'inserts'   : 0,
-                'deletes'   : 0,
-            }
-        else:
-            raise Exception("Unrecognized line {}".format(line))
-    if commit:
-        commits.append(commit)
-    return commits
+class CommitParser():
+    """
+    Incrementally parses the output of git log --shortstat. Lines can be fed
+    in as they arrive and finished commits are yielded as soon as the next
+    commit header or blank line shows they are complete
+    """
+    def __init__(self):
+        self.commit = {}
 
-@asyncio.coroutine
-def get_commits(repository, start, end=None):
-    path = repository.path
+    def feed(self, lines):
+        for line in lines:
+            if not line:
+                if self.commit:
+                    yield self.commit
+                    self.commit = {}
+            elif line.startswith(' '):
+                _add_stats(self.commit, line)
+            elif line.startswith('"') and line.endswith('"'):
+                if self.commit:
+                    yield self.commit
+
+                line = line[1:-1]
+                _hash, _datetime, _author = line.split(' ')
+                self.commit = {
+                    'author'    : _author,
+                    'datetime'  : dashi.timestamp.parse(_datetime),
+                    'hash'      : _hash,
+                    'files'     : 0,
+                    'inserts'   : 0,
+                    'deletes'   : 0,
+                }
+            else:
+                raise Exception("Unrecognized line {}".format(line))
+
+    def close(self):
+        if self.commit:
+            yield self.commit
+            self.commit = {}
+
+def _log_command(start, end=None, revisions=None, exclude=None):
     command = [
             'git',
             'log',
             '--pretty=format:"%h %aI %aE"',
             '--shortstat',
-            '--all',
             '--after={}'.format(start.isoformat())]
     if end is not None:
         command.append('--before={}'.format(end.isoformat()))
-    yield from run_process(command, chdir=path)
-    output = subprocess.check_output(command)
-    output = output.decode('utf-8')
-    commits = _parse_commits(output)
-    for commit in commits:
-        commit['repo'] = repository.name
+    if revisions is None:
+        command.append('--all')
+    else:
+        command += revisions
+        if exclude:
+            command += ['--not'] + exclude
+        command.append('--')
+    return command
+
+@asyncio.coroutine
+def stream_commits(repository, start, handler, end=None, timeout=None, revisions=None, exclude=None):
+    """
+    Run git log for the repository and call handler with each commit as soon
+    as it has been parsed, without holding the whole log in memory
+    """
+    parser = CommitParser()
+    def _handle(commits):
+        for commit in commits:
+            commit['repo'] = repository.name
+            handler(commit)
+
+    yield from stream_process(
+        _log_command(start, end, revisions, exclude),
+        lambda lines: _handle(parser.feed(lines)),
+        chdir=repository.path,
+        timeout=timeout,
+    )
+    _handle(parser.close())
+
+@asyncio.coroutine
+def get_refs(repository, timeout=None):
+    command = ['git', 'for-each-ref', '--format=%(objectname) %(refname)']
+    output, _ = yield from run_process(command, chdir=repository.path, timeout=timeout)
+    refs = {}
+    for line in output.decode('utf-8').splitlines():
+        sha, _, refname = line.partition(' ')
+        refs[refname] = sha
+    return refs
+
+@asyncio.coroutine
+def is_ancestor(repository, ancestor, descendant, timeout=None):
+    "Whether descendant contains ancestor. False if either is no longer in the repository"
+    command = ['git', 'merge-base', '--is-ancestor', ancestor, descendant]
+    process = yield from asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL, cwd=repository.path)
+    try:
+        returncode = yield from asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        yield from process.wait()
+        raise Exception("Timed out after {} seconds running {} in {}".format(timeout, " ".join(command), repository.path))
+    return returncode == 0
+
+@asyncio.coroutine
+def reachable_commits(repository, since, timeout=None):
+    "The full hash of every commit any ref still reaches, back to since"
+    command = ['git', 'rev-list', '--all', '--since={}'.format(since.isoformat())]
+    output, _ = yield from run_process(command, chdir=repository.path, timeout=timeout)
+    return set(output.decode('utf-8').split())
+
+@asyncio.coroutine
+def _rewritten_refs(repository, old_refs, refs, timeout):
+    "The recorded refs that have been deleted or moved somewhere that doesn't contain where they were"
+    rewritten = []
+    for refname, sha in sorted(old_refs.items()):
+        if refname not in refs:
+            rewritten.append(refname)
+        elif refs[refname] != sha and not (yield from is_ancestor(repository, sha, refs[refname], timeout)):
+            rewritten.append(refname)
+    return rewritten
+
+@asyncio.coroutine
+def update_index(repository, index, start, timeout=None):
+    """
+    Bring the index up to date with the repository. Returns the commits that
+    were added and the ones that were dropped because a force-push, rebase,
+    amend or deleted branch means nothing reaches them any more
+    """
+    refs = yield from get_refs(repository, timeout)
+    index.look_back_to(start)
+    if not index.covers(start):
+        LOGGER.debug("Commit index for %s does not go back to %s, rebuilding it", repository.name, start)
+        index.reset(start)
+
+    removed = []
+    rewritten = yield from _rewritten_refs(repository, index.refs, refs, timeout)
+    if rewritten:
+        LOGGER.debug("Refs %s in %s were rewritten or deleted, pruning unreachable commits from the index", rewritten, repository.name)
+        removed = index.prune((yield from reachable_commits(repository, index.since, timeout)))
+        index.refs = {refname: sha for refname, sha in index.refs.items() if refname not in rewritten}
+
+    exclude = sorted(set(index.refs.values()))
+    revisions = sorted(set(refs.values()) - set(exclude))
+    if not revisions:
+        LOGGER.debug("No new commits in %s", repository.name)
+        if removed:
+            index.refs = refs
+            index.save()
+        return [], removed
+
+    commits = []
+    try:
+        yield from stream_commits(repository, index.since, commits.append,
+            timeout=timeout, revisions=revisions, exclude=exclude)
+    except Exception as e: # pylint: disable=broad-except
+        if not exclude:
+            raise
+        # The refs we saw last time may have been force-pushed away and garbage collected
+        LOGGER.warning("Unable to update commit index for %s incrementally, rebuilding it: %s", repository.name, e)
+        previous = index.commits
+        index.reset(index.since)
+        commits = []
+        yield from stream_commits(repository, index.since, commits.append,
+            timeout=timeout, revisions=sorted(set(refs.values())))
+        index.merge(commits, refs)
+        index.save()
+        known, found = {commit['hash'] for commit in previous}, {commit['hash'] for commit in commits}
+        return ([commit for commit in commits if commit['hash'] not in known],
+            removed + [commit for commit in previous if commit['hash'] not in found])
+    added = index.merge(commits, refs)
+    index.save()
+    LOGGER.debug("Added %d and removed %d commits in the index for %s", len(added), len(removed), repository.name)
+    return added, removed
+
+@asyncio.coroutine
+def get_commits(repository, start, end=None, timeout=None, index=None):
+    if index is not None:
+        yield from update_index(repository, index, start, timeout)
+        return index.between(start, end)
+
+    commits = []
+    yield from stream_commits(repository, start, commits.append, end=end, timeout=timeout)
     return commits
 
-def sort_commits(user, commits):
-    def _key(commit):
-        return ':'.join([commit['repo'], commit['datetime'].isoformat(), commit['hash']])
-    my_commits = [commit for commit in commits if commit['author'] in user.aliases]
-    return sorted(my_commits, key=_key)
+def _sort_key(commit):
+    return ':'.join([commit['repo'], commit['datetime'].isoformat(), commit['hash']])
+
+def group_commits(aliases, commits):
+    grouped = {}
+    for commit in commits:
+        user = aliases.get(commit['author'])
+        if user is not None:
+            grouped.setdefault(user, []).append(commit)
+    return grouped
+
+def collate_commits(users, aliases, commits):
+    grouped = group_commits(aliases, commits)
+    result = {}
+    for user in users:
+        my_commits = grouped.get(user, [])
+        result[user.name] = {
+            'commits'       : sorted(my_commits, key=_sort_key),
+            'percentage'    : round(len(my_commits) / float(len(commits)), 2) * 100 if commits else 0,
+        }
+    return result
 
-def percentage(user, commits):
-    return len([commit for commit in commits if commit['author'] in user.aliases]) / float(len(commits))
+@asyncio.coroutine
+def _get_commits_limited(semaphore, repository, start, timeout, index):
+    yield from semaphore.acquire()
+    try:
+        return (yield from get_commits(repository, start, timeout=timeout, index=index))
+    except Exception as e: # pylint: disable=broad-except
+        LOGGER.error("Unable to get commits for %s, skipping it: %s", repository.name, e)
+        return []
+    finally:
+        semaphore.release()
 
-def collate_commits(users, commits):
-    return {
-    user.name           : {
-        'commits'       : sort_commits(user, commits),
-        'percentage'    : round(percentage(user, commits), 2) * 100,
-    } for user in users}
+@asyncio.coroutine
+def collect_commits(config, timepoint, purpose=None):
+    options = config.get('git', {})
+    semaphore = asyncio.Semaphore(options.get('concurrency', DEFAULT_CONCURRENCY))
+    timeout = options.get('timeout', DEFAULT_TIMEOUT)
+    use_index = options.get('index', True)
+    coros = [_get_commits_limited(
+        semaphore,
+        repository,
+        timepoint,
+        timeout,
+        dashi.commitindex.load(config, repository, purpose) if use_index else None,
+    ) for repository in config['repositories']]
+    results = yield from asyncio.gather(*coros)
+    all_commits = [commit for commits in results for commit in commits]
+    return list(get_recognized_commits(config['aliases'], all_commits))
 
 @asyncio.coroutine
 def get_all_commits(config, timepoint):
-    all_commits = []
-    for repository in config['repositories']:
-        commits = yield from get_commits(config, repository, timepoint)
-        all_commits += commits
-    all_commits = list(get_recognized_commits(config['users'], all_commits))
-    all_commits = collate_commits(config['users'], all_commits)
-    return all_commits
-
-def _commit_is_from_a_user(commit, users):
-    for user in users:
-        if commit['author'] in user.aliases:
-            return True
-    return False
+    all_commits = yield from collect_commits(config, timepoint)
+    return collate_commits(config['users'], config['aliases'], all_commits)
+
+@asyncio.coroutine
+def get_all_commits_by_period(config, periods):
+    """
+    Collated commits for each of periods, reading the repositories only
+    once. Backfills reach much further back than weekly runs so they keep
+    an index of their own rather than widening the one weekly runs use
+    """
+    all_commits = yield from collect_commits(config, periods[0][0], 'backfill')
+    return [collate_commits(config['users'], config['aliases'], commits)
+        for commits in split_by_period(all_commits, periods)]
 
-def get_recognized_commits(users, commits):
+def get_recognized_commits(aliases, commits):
     unrecognized_authors = set()
     for commit in commits:
-        if _commit_is_from_a_user(commit, users):
+        if commit['author'] in aliases:
             yield commit
         else:
             unrecognized_authors.add(commit['author'])
@@ -161,17 +351,65 @@ def get_recognized_commits(users, commits):
 def commits_between(start, end, all_commits):
     return [commit for commit in all_commits if end > commit['datetime'] > start]
 
+def split_by_period(all_commits, periods):
+    "commits_between for each of periods, sorting once and bisecting instead of scanning every commit per period"
+    ordered = sorted(all_commits, key=lambda commit: commit['datetime'])
+    datetimes = [commit['datetime'] for commit in ordered]
+    return [ordered[bisect.bisect_right(datetimes, start):bisect.bisect_left(datetimes, end)]
+        for start, end in periods]
+
 @asyncio.coroutine
-def run_process(command, chdir=None):
-    if chdir:
-        os.chdir(chdir)
-        LOGGER.debug("Executing %s in %s", " ".join(command), chdir)
-    process = yield from asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
-    (stdout, stderr) = yield from process.communicate()
+def run_process(command, chdir=None, timeout=None):
+    LOGGER.debug("Executing %s in %s", " ".join(command), chdir or os.getcwd())
+    process = yield from asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, cwd=chdir)
+    try:
+        (stdout, stderr) = yield from asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        yield from process.wait()
+        raise Exception("Timed out after {} seconds running {} in {}".format(timeout, " ".join(command), chdir))
     if process.returncode != 0:
-        raise Exception("Failed to update git repository %s", repo)
+        raise Exception("Failed to run {} in {}: exit code {}".format(" ".join(command), chdir, process.returncode))
     return stdout, stderr
 
+@asyncio.coroutine
+def _read_lines(stream, consume):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while True:
+        chunk = yield from stream.read(CHUNK_SIZE)
+        pending += decoder.decode(chunk, final=not chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        consume(lines)
+        if not chunk:
+            break
+    if pending:
+        consume([pending])
+
+@asyncio.coroutine
+def stream_process(command, consume, chdir=None, timeout=None):
+    """
+    Like run_process but hands stdout to consume as lists of complete lines
+    while the process is still running
+    """
+    LOGGER.debug("Streaming %s in %s", " ".join(command), chdir or os.getcwd())
+    process = yield from asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, cwd=chdir)
+
+    @asyncio.coroutine
+    def _run():
+        yield from _read_lines(process.stdout, consume)
+        yield from process.wait()
+
+    try:
+        yield from asyncio.wait_for(_run(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        yield from process.wait()
+        raise Exception("Timed out after {} seconds running {} in {}".format(timeout, " ".join(command), chdir))
+    if process.returncode != 0:
+        raise Exception("Failed to run {} in {}: exit code {}".format(" ".join(command), chdir, process.returncode))
+
 @asyncio.coroutine
 def update_repo(repository):
     command = ['git', 'pull']
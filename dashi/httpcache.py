@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+import requests.structures
+
+import dashi.json
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL = 4 * 60 * 60
+# Listings say which issues there are, so they go back to the server every
+# time while the issues they point to can still be served from the cache.
+# Configured ttls take precedence
+LISTING_TTLS = {
+    '/rest/api/2/search'    : 0,
+    '/groups/?query='       : 0,
+}
+# Response headers worth keeping. The validators let us revalidate, link carries Sentry's cursors
+KEPT_HEADERS = ('content-type', 'etag', 'last-modified', 'link')
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+def get(config):
+    "Get the cache described by config, shared by everything in this process that uses the same directory"
+    options = config.get('cache', {})
+    path = options.get('path', os.path.join(os.environ['HOME'], '.dashi', 'http'))
+    with _CACHES_LOCK:
+        if path not in _CACHES:
+            _CACHES[path] = ResponseCache(
+                path,
+                max_bytes   = options.get('max_bytes', DEFAULT_MAX_BYTES),
+                ttls        = options.get('ttls', {}),
+                default_ttl = options.get('ttl', DEFAULT_TTL),
+            )
+        return _CACHES[path]
+
+class ResponseCache():
+    """
+    HTTP responses on disk, one file per request. Entries are served without
+    asking the server until their TTL runs out and are then revalidated with
+    whatever ETag or Last-Modified the server gave us. The least recently used
+    entries are dropped once the directory grows past max_bytes
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, ttls=None, default_ttl=DEFAULT_TTL):
+        self.path           = path
+        self.max_bytes      = max_bytes
+        self.ttls           = dict(ttls or {})
+        for pattern, ttl in LISTING_TTLS.items():
+            self.ttls.setdefault(pattern, ttl)
+        self.default_ttl    = default_ttl
+        self.hits           = 0
+        self.misses         = 0
+        self.revalidated    = 0
+        self.lock           = threading.Lock()
+        self._size          = None
+
+    @staticmethod
+    def key(method, url, body=None):
+        value = json.dumps([method.upper(), url, body], sort_keys=True)
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    def ttl(self, url):
+        "The TTL of the first configured pattern found in url, or the default"
+        for pattern, ttl in self.ttls.items():
+            if pattern in url:
+                return ttl
+        return self.default_ttl
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored'] < self.ttl(entry['url'])
+
+    @staticmethod
+    def validators(entry):
+        headers = {}
+        if entry['headers'].get('etag'):
+            headers['If-None-Match'] = entry['headers']['etag']
+        if entry['headers'].get('last-modified'):
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+        return headers
+
+    def record(self, outcome):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidated}
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            LOGGER.warning("Ignoring unreadable cache entry %s: %s", path, e)
+            return None
+        # The modification time doubles as the last access time for eviction
+        os.utime(path)
+        return entry
+
+    def put(self, key, entry):
+        path = self._entry_path(key)
+        data = json.dumps(entry).encode('utf-8')
+        try:
+            previous = os.path.getsize(path)
+        except FileNotFoundError:
+            previous = 0
+        with dashi.json.atomic_write(path, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data) - previous
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                stat = entry.stat()
+                yield stat.st_mtime, stat.st_size, entry.path
+
+    def _evict(self):
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(self._entries()):
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+        LOGGER.debug("Evicted HTTP cache entries down to %d bytes", self._size)
+
+def _to_response(entry):
+    response = requests.Response()
+    response.url = entry['url']
+    response.status_code = entry['status']
+    response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+    response.encoding = 'utf-8'
+    response._content = entry['body'].encode('utf-8') # pylint: disable=protected-access
+    return response
+
+def new_entry(url, status, headers, body):
+    return {
+        'url'       : url,
+        'status'    : status,
+        'headers'   : {name: headers[name] for name in KEPT_HEADERS if name in headers},
+        'body'      : body,
+        'stored'    : time.time(),
+    }
+
+class CachedSession(requests.Session):
+    """
+    A requests session that answers from a ResponseCache when it can.
+    Only successful responses are stored so throttling and errors always
+    reach the caller
+    """
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def request(self, method, url, *args, **kwargs): # pylint: disable=arguments-differ
+        key = self.cache.key(method, url, kwargs.get('json', kwargs.get('data')))
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.is_fresh(entry):
+            self.cache.record('hits')
+            return _to_response(entry)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            headers.update(self.cache.validators(entry))
+        response = super().request(method, url, *args, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.record('revalidated')
+            entry['stored'] = time.time()
+            self.cache.put(key, entry)
+            return _to_response(entry)
+
+        self.cache.record('misses')
+        if response.ok:
+            body = response.content.decode(response.encoding or 'utf-8')
+            self.cache.put(key, new_entry(response.url, response.status_code, response.headers, body))
+        return response
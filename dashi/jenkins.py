@@ -1,10 +1,18 @@
+import concurrent.futures
+import datetime
 import logging
 
-from jenkinsapi.custom_exceptions import NoResults, UnknownJob
-from jenkinsapi.jenkins import Jenkins
+import requests
+import requests.adapters
+
+import dashi.time
 
 LOGGER = logging.getLogger(__name__)
 
+DEFAULT_CONCURRENCY = 8
+# How many of the newest builds to look through for test results
+DEFAULT_BUILDS = 25
+
 def _add_build(results, build):
     timestamp = build.get_timestamp()
     for r in results:
@@ -14,61 +22,145 @@ def _add_build(results, build):
             LOGGER.debug("Added %s with %s tests", build.name, len(resultset))
 
 def get_jenkins_stats(config):
-    jenkins = connect(config)
-    return {job : get_latest_build(jenkins, job) for job in config['jenkins']['jobs']}
-
-def connect(config):
-    return Jenkins(
-        config['jenkins']['url'],
-        username=config['jenkins']['username'],
-        password=config['jenkins']['password'],
-    )
-
-def get_test_results_by_time_periods(config, repos):
-    jenkins = connect(config)
-    return {
-            repo['name']    : get_test_results_for_repo(jenkins, repo)
-        for repo in repos}
-
-def get_latest_build(jenkins, jobname):
-    try:
-        job = jenkins[jobname]
-    except UnknownJob:
+    session = create_session(config)
+    return {job : get_latest_build(config, session, job) for job in config['jenkins']['jobs']}
+
+def get_jenkins_stats_by_period(config, periods):
+    """
+    For each of periods the newest build with tests that started before the
+    period ended, the same shape get_jenkins_stats gives for now. Each job's
+    history is read once for all of them
+    """
+    session = create_session(config)
+    histories = {job: get_test_history(config, session, job)[0] for job in config['jenkins']['jobs']}
+    return [{job: _latest_before(rows, end) for job, rows in histories.items()} for _, end in periods]
+
+def _latest_before(rows, end):
+    for row in reversed(rows):
+        if row['date'] < end:
+            return {
+                    'build'     : row['build'],
+                    'timestamp' : row['date'],
+                    'tests'     : row['tests'],
+                    }
+
+def create_session(config):
+    concurrency = config['jenkins'].get('concurrency', DEFAULT_CONCURRENCY)
+    session = requests.Session()
+    session.auth = (config['jenkins']['username'], config['jenkins']['password'])
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def _job_url(config, jobname):
+    return '{}/job/{}/'.format(config['jenkins']['url'].rstrip('/'), jobname)
+
+def _get_json(session, url, tree):
+    response = session.get(url, params={'tree': tree})
+    if response.status_code == 404:
+        return None
+    if not response.ok:
+        raise Exception("Failed to get {}: {} {}".format(url, response.status_code, response.text))
+    return response.json()
+
+def _to_datetime(milliseconds):
+    return datetime.datetime.fromtimestamp(milliseconds / 1000.0, dashi.time.UTC())
+
+def _test_count(build):
+    for action in build.get('actions', []):
+        if action and 'totalCount' in action:
+            return action['totalCount']
+    return None
+
+def get_latest_build(config, session, jobname):
+    """
+    Find the newest build with test results. One request for the newest
+    builds usually answers it because the test action carries the count.
+    If none of them do we ask each build's test report directly, a batch at
+    a time, newest first
+    """
+    count = config['jenkins'].get('builds', DEFAULT_BUILDS)
+    tree = 'builds[number,timestamp,actions[totalCount]]{{0,{}}}'.format(count)
+    data = _get_json(session, _job_url(config, jobname) + 'api/json', tree)
+    if data is None:
         LOGGER.warning("Unable to get data on Jenkins job %s", jobname)
         return
-    build_ids = job.get_build_ids()
-    latest_build = max(build_ids)
-    for build_id in range(latest_build)[::-1]:
-        build = job.get_build(build_id)
-        try:
-            resultset = build.get_resultset()
+    for build in data['builds']:
+        tests = _test_count(build)
+        if tests is not None:
             return {
-                    'build'     : build.buildno,
-                    'timestamp' : build.get_timestamp(),
-                    'tests'     : len(resultset),
+                    'build'     : build['number'],
+                    'timestamp' : _to_datetime(build['timestamp']),
+                    'tests'     : tests,
                     }
-        except NoResults:
-            pass
-
-def get_test_results_for_repo(jenkins, repo):
-    try:
-        job = jenkins[repo['name']]
-    except UnknownJob:
-        LOGGER.warning("Unable to get data on Jenkins job %s", repo['name'])
-        return []
-
-    results = []
-    build_ids = job.get_build_ids()
-    for build_id in build_ids:
-        build = job.get_build(build_id)
-        try:
-            resultset = build.get_resultset()
-            results.append({
-                'name'  : repo['name'],
-                'date'  : build.get_timestamp(),
-                'build' : build.buildno,
-                'tests' : len(resultset),
-            })
-        except NoResults:
-            pass
-    return results
+    return _probe_latest_build(config, session, jobname, data['builds'])
+
+def _get_test_report_count(config, session, jobname, number):
+    url = '{}{}/testReport/api/json'.format(_job_url(config, jobname), number)
+    report = _get_json(session, url, 'totalCount')
+    return report['totalCount'] if report else None
+
+def _probe_latest_build(config, session, jobname, builds):
+    concurrency = config['jenkins'].get('concurrency', DEFAULT_CONCURRENCY)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for offset in range(0, len(builds), concurrency):
+            batch = builds[offset:offset + concurrency]
+            counts = executor.map(lambda build: _get_test_report_count(config, session, jobname, build['number']), batch)
+            for build, tests in zip(batch, counts):
+                if tests is not None:
+                    return {
+                            'build'     : build['number'],
+                            'timestamp' : _to_datetime(build['timestamp']),
+                            'tests'     : tests,
+                            }
+    LOGGER.warning("None of the last %d builds of %s have test results", len(builds), jobname)
+
+def _get_builds(config, session, jobname, after):
+    # builds only lists the newest hundred or so, fall back to allBuilds when
+    # there are more new ones than that
+    fields = '[number,timestamp,building,actions[totalCount]]'
+    url = _job_url(config, jobname) + 'api/json'
+    if after:
+        data = _get_json(session, url, 'builds' + fields)
+        if data is None:
+            return None
+        if not data['builds'] or data['builds'][-1]['number'] <= after + 1:
+            return data['builds']
+    data = _get_json(session, url, 'allBuilds' + fields)
+    return data['allBuilds'] if data else None
+
+def get_test_history(config, session, jobname, after=0):
+    """
+    Get the test count of every finished build of a job newer than after.
+    Returns the rows and the build number the job has been synced up to,
+    which stops short of any build that is still running so that it gets
+    picked up once it finishes
+    """
+    builds = _get_builds(config, session, jobname, after)
+    if builds is None:
+        LOGGER.warning("Unable to get data on Jenkins job %s", jobname)
+        return [], after
+
+    builds = sorted([build for build in builds if build['number'] > after], key=lambda build: build['number'])
+    running = [build['number'] for build in builds if build['building']]
+    if running:
+        builds = [build for build in builds if build['number'] < min(running)]
+    synced = builds[-1]['number'] if builds else after
+
+    counts = {build['number']: _test_count(build) for build in builds}
+    missing = [build['number'] for build in builds if counts[build['number']] is None]
+    if missing:
+        concurrency = config['jenkins'].get('concurrency', DEFAULT_CONCURRENCY)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            counts.update(zip(missing, executor.map(
+                lambda number: _get_test_report_count(config, session, jobname, number), missing)))
+
+    rows = [{
+        'name'  : jobname,
+        'date'  : _to_datetime(build['timestamp']),
+        'build' : build['number'],
+        'tests' : counts[build['number']],
+    } for build in builds if counts[build['number']] is not None]
+    LOGGER.debug("Found %d new builds with tests for %s, synced to build %s", len(rows), jobname, synced)
+    return rows, synced
@@ -1,69 +1,118 @@
+import concurrent.futures
 import logging
 
 import requests
+import requests.adapters
 import requests.auth
 
+import dashi.httpcache
+
 LOGGER = logging.getLogger(__name__)
 
+DEFAULT_FANOUT = 4
+SEARCH_URL = "https://sendshapes.atlassian.net/rest/api/2/search"
+
+# Only the fields get_statistics looks at, everything else is left on the server
+STATISTICS_FIELDS = [
+    "aggregatetimeestimate",
+    "aggregatetimeoriginalestimate",
+    "assignee",
+    "created",
+    "customfield_10008",
+    "resolutiondate",
+]
+
 def get_statistics(config, start, end):
-    session = create_session(**config['jira'])
-    created = issues_created_between(session, start, end)
-    without_epic = _get_without_epic(created)
-    without_estimate = _get_without_estimate(created)
-    resolved = issues_resolved_between(session, start, end)
-    return {
-        'created'           : created['total'],
-        'resolved'          : resolved['total'],
-        'without_estimate'  : len(without_estimate),
-        'without_epic'      : len(without_epic),
-        'personal'          : {user.name: len(_get_personally_resolved(resolved, user)) for user in config['users']}
-    }
+    fanout = config['jira'].get('fanout', DEFAULT_FANOUT)
+    session = create_session(config['jira']['username'], config['jira']['password'], dashi.httpcache.get(config), fanout)
+    issues = issues_created_or_resolved_between(session, start, end, fanout)
+    return aggregate(issues, config['users'], start, end)
 
-def create_session(username, password):
+def get_statistics_by_period(config, periods):
+    "Statistics for each of periods from a single search covering all of them"
+    fanout = config['jira'].get('fanout', DEFAULT_FANOUT)
+    session = create_session(config['jira']['username'], config['jira']['password'], dashi.httpcache.get(config), fanout)
+    issues = list(issues_created_or_resolved_between(session, periods[0][0], periods[-1][1], fanout))
+    return [aggregate(issues, config['users'], start, end) for start, end in periods]
+
+def create_session(username, password, cache, fanout=DEFAULT_FANOUT):
     auth = requests.auth.HTTPBasicAuth(username, password)
-    session =  requests.Session()
+    session =  dashi.httpcache.CachedSession(cache)
     session.auth = auth
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=fanout)
+    session.mount('https://', adapter)
     return session
 
-def _get_without_epic(created):
-    without_epic = [issue for issue in created['issues'] if issue['fields']['customfield_10008'] is None]
-    return without_epic
-
-def _get_without_estimate(created):
-    def _has_estimate(issue):
-        return any([issue['fields']['aggregatetimeestimate'],
-                    issue['fields']['aggregatetimeoriginalestimate']])
-
-    without_estimate = [issue for issue in created['issues'] if not _has_estimate(issue)]
-    return without_estimate
-
-def _get_personally_resolved(resolved, user):
-    results = []
-    for issue in resolved['issues']:
-        assignee = issue['fields']['assignee']
-        key = assignee['key'] if assignee is not None else None
-        if key == user.config.get('jirakey', None):
-            results.append(issue)
-    return results
+def _has_estimate(issue):
+    return any([issue['fields']['aggregatetimeestimate'],
+                issue['fields']['aggregatetimeoriginalestimate']])
 
-def _do_search(session, payload, startAt=None):
-    startAt = startAt if startAt is not None else 0
-    payload['startAt'] = startAt
-    response = session.post("https://sendshapes.atlassian.net/rest/api/2/search", json=payload)
+def _on_day_between(timestamp, first_day, last_day):
+    # Jira renders timestamps in the same timezone it evaluates JQL dates in, so
+    # comparing the date part gives the same answer the server did
+    return timestamp is not None and first_day <= timestamp[:10] < last_day
+
+def aggregate(issues, users, start, end):
+    first_day, last_day = start.date().isoformat(), end.date().isoformat()
+    users_by_key = {user.config['jirakey']: user for user in users if 'jirakey' in user.config}
+    statistics = {
+        'created'           : 0,
+        'resolved'          : 0,
+        'without_estimate'  : 0,
+        'without_epic'      : 0,
+        'personal'          : {user.name: 0 for user in users},
+    }
+    for issue in issues:
+        fields = issue['fields']
+        if _on_day_between(fields['created'], first_day, last_day):
+            statistics['created'] += 1
+            if fields['customfield_10008'] is None:
+                statistics['without_epic'] += 1
+            if not _has_estimate(issue):
+                statistics['without_estimate'] += 1
+        if _on_day_between(fields['resolutiondate'], first_day, last_day):
+            statistics['resolved'] += 1
+            assignee = fields['assignee']
+            user = users_by_key.get(assignee['key']) if assignee is not None else None
+            if user is not None:
+                statistics['personal'][user.name] += 1
+    return statistics
+
+def _do_search(session, payload, startAt=None, maxResults=None):
+    payload = dict(payload, startAt=startAt if startAt is not None else 0)
+    if maxResults is not None:
+        payload['maxResults'] = maxResults
+    response = session.post(SEARCH_URL, json=payload)
     if not response.ok:
         raise Exception("Failed to query jira: {}".format(response.json()))
     data = response.json()
     return data
 
-def search(session, payload):
-    startAt = 0
-    data = _do_search(session, payload, startAt)
-    results = data
-    while results['total'] > results['maxResults']:
-        startAt += data['maxResults']
-        data = _do_search(session, payload, startAt)
-        results['maxResults'] += data['maxResults']
-        results['issues'] += data['issues']
+def _pages(session, payload, fanout):
+    """
+    Yield every page of a search in order. The first page tells us the total
+    and the page size so the remaining offsets are known up front and are
+    fetched concurrently
+    """
+    first = _do_search(session, payload, 0)
+    yield first
+    page_size = first['maxResults']
+    offsets = range(page_size, first['total'], page_size) if page_size else []
+    if offsets:
+        LOGGER.debug("Fetching %d more pages of %s", len(offsets), payload['jql'])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=fanout) as executor:
+            yield from executor.map(lambda startAt: _do_search(session, payload, startAt, page_size), offsets)
+
+def iter_search(session, payload, fanout=DEFAULT_FANOUT):
+    for page in _pages(session, payload, fanout):
+        yield from page['issues']
+
+def search(session, payload, fanout=DEFAULT_FANOUT):
+    pages = _pages(session, payload, fanout)
+    results = next(pages)
+    for page in pages:
+        results['issues'] += page['issues']
+    results['maxResults'] = len(results['issues'])
     return results
 
 def get_issue(session, issue):
@@ -72,26 +121,11 @@ def get_issue(session, issue):
     }
     return search(session, query)
 
-def issues_created_between(session, start, end):
-    jql = "created >= {} AND created < {}".format(start.date().isoformat(), end.date().isoformat())
+def issues_created_or_resolved_between(session, start, end, fanout=DEFAULT_FANOUT):
+    jql = "(created >= {0} AND created < {1}) OR (resolved >= {0} AND resolved < {1})".format(
+        start.date().isoformat(), end.date().isoformat())
     query = {
         "jql"           : jql,
-        "fields"        : [
-            "aggregateprogress",
-            "aggregatetimeestimate",
-            "aggregatetimeoriginalestimate",
-            "aggregatetimespent",
-            "created",
-            "customfield_10008",
-            "id",
-        ],
+        "fields"        : STATISTICS_FIELDS,
     }
-    return search(session, query)
-
-def issues_resolved_between(session, start, end):
-    jql = "resolved >= {} AND resolved < {}".format(start.date().isoformat(), end.date().isoformat())
-    query = {
-         "jql"      : jql,
-         "fields"   : ["assignee", "id", "resolved"],
-     }
-    return search(session, query)
+    return iter_search(session, query, fanout)
@@ -1,8 +1,21 @@
+import contextlib
 import datetime
+import gzip
+import hashlib
 import json
+import os
+import threading
 
 import dashi.config
+import dashi.timestamp
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CHUNK_SIZE = 64 * 1024
+_PLAIN = (str, int, float, bool, type(None))
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj): # pylint: disable=method-hidden
@@ -14,5 +27,135 @@ class MyEncoder(json.JSONEncoder):
             return obj.name
         return json.JSONEncoder.default(self, obj)
 
+class TaggedEncoder(json.JSONEncoder):
+    "Like MyEncoder but marks what each value was so load_tagged can restore it"
+    def default(self, obj): # pylint: disable=method-hidden
+        if isinstance(obj, datetime.datetime):
+            return {'__datetime__': obj.isoformat()}
+        elif isinstance(obj, dashi.config.User):
+            return {'__user__': obj.name}
+        return json.JSONEncoder.default(self, obj)
+
+def _key(key):
+    return key.name if isinstance(key, (dashi.config.User, dashi.config.Repository)) else key
+
+def _value(value):
+    # Most values are already plain, checking for that here saves a call for each of them
+    return value if type(value) in _PLAIN else normalise(value)
+
+def normalise(obj):
+    """
+    The same value MyEncoder would write but made of plain JSON types, so
+    it can be encoded without a Python callback for every datetime and user
+    and encoded again without converting anything twice
+    """
+    kind = type(obj)
+    if kind in _PLAIN:
+        return obj
+    elif kind is dict:
+        return {key if type(key) is str else _key(key): _value(value) for key, value in obj.items()}
+    elif kind in (list, tuple):
+        return [_value(value) for value in obj]
+    elif isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    elif isinstance(obj, (dashi.config.User, dashi.config.Repository)):
+        return obj.name
+    elif isinstance(obj, dict):
+        return {_key(key): _value(value) for key, value in obj.items()}
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+def _default(obj):
+    return normalise(obj)
+
+def dumps(obj, sort_keys=False):
+    "Encode obj to UTF-8 bytes with orjson when it is installed"
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, cls=MyEncoder, sort_keys=sort_keys, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _chunks(obj):
+    """
+    The encoded obj in pieces. The stdlib only uses its C encoder when it
+    encodes a whole value at once, so a dict is written one item at a
+    time, which keeps that speed without holding all of it in memory
+    """
+    if orjson is not None:
+        yield orjson.dumps(obj, default=_default)
+        return
+    encoder = MyEncoder(ensure_ascii=False, check_circular=False, separators=(',', ':'))
+    if type(obj) is not dict:
+        yield encoder.encode(obj).encode('utf-8')
+        return
+    separator = '{'
+    for key, value in obj.items():
+        yield '{}{}:{}'.format(separator, encoder.encode(_key(key)), encoder.encode(value)).encode('utf-8')
+        separator = ','
+    yield b'{}' if separator == '{' else b'}'
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    """
+    Open a file to write path's new content to and move it over path when
+    the block finishes, so readers only ever see the old file or the whole
+    new one. Nothing changes if the block raises. The directory is created
+    if it is missing and every thread gets its own temporary file
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(temporary, mode) as f:
+            yield f
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+class _Unchanged(Exception):
+    "Raised inside atomic_write to leave the file that is already there alone"
+
+def dump_file(obj, path, previous=None, compress=False):
+    """
+    Stream obj into a new file for path, hashing it on the way. When compress
+    is set a gzipped copy goes to path.gz as well. If the hash is previous
+    and the files already exist they can't have changed and are left as they
+    are. Returns the hash and whether the content changed
+    """
+    existed = os.path.exists(path) and (not compress or os.path.exists(path + '.gz'))
+    digest = hashlib.sha1()
+    try:
+        with atomic_write(path, 'wb') as f:
+            for chunk in _chunks(obj):
+                digest.update(chunk)
+                f.write(chunk)
+            if digest.hexdigest() == previous and existed:
+                raise _Unchanged()
+    except _Unchanged:
+        return previous, False
+    fingerprint = digest.hexdigest()
+    if compress:
+        _gzip_file(path, path + '.gz')
+    return fingerprint, True
+
+def _gzip_file(source, destination):
+    # A fixed mtime keeps the compressed bytes the same for the same content
+    with open(source, 'rb') as f, atomic_write(destination, 'wb') as raw:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=raw, compresslevel=6, mtime=0) as compressed:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                compressed.write(chunk)
+
 def dump(obj, f):
     json.dump(obj, f, cls=MyEncoder)
+
+def dump_tagged(obj, f):
+    json.dump(obj, f, cls=TaggedEncoder)
+
+def load_tagged(f, users):
+    by_name = {user.name: user for user in users}
+    def _hook(obj):
+        if '__datetime__' in obj:
+            return dashi.timestamp.parse(obj['__datetime__'])
+        elif '__user__' in obj:
+            return by_name[obj['__user__']]
+        return obj
+    return json.load(f, object_hook=_hook)
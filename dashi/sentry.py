@@ -1,47 +1,135 @@
+import concurrent.futures
+import json
 import logging
+import os
+import time
 
-import dateutil
 import requests
+import requests.adapters
+
+import dashi.httpcache
+import dashi.json
+import dashi.timestamp
 
 LOGGER = logging.getLogger(__name__)
 
+DEFAULT_CONCURRENCY = 8
 
 def get_statistics(config, start, end):
+    return get_statistics_by_period(config, [(start, end)])[0]
+
+def get_statistics_by_period(config, periods):
+    "Statistics for each of periods from a single pass over the resolved issues"
+    records = fetch_resolved_issues(config)
+    return [summarise(config, records, start, end) for start, end in periods]
+
+def get_resolutions(config):
+    "One row per resolved issue with when it was resolved and the Sentry name of who did it"
+    return [{
+        'id'        : record['id'],
+        'project'   : record['project'],
+        'date'      : record['resolved_at'],
+        'resolver'  : record['resolvers'][0] if record['resolvers'] else None,
+    } for record in fetch_resolved_issues(config) if record['resolved_at'] is not None]
+
+def fetch_resolved_issues(config):
+    concurrency = config['sentry'].get('concurrency', DEFAULT_CONCURRENCY)
+    session = create_session(
+        config['sentry']['username'],
+        config['sentry']['password'],
+        config['sentry']['url'],
+        dashi.httpcache.get(config),
+        concurrency,
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return get_resolved_issues(config, session, executor)
+
+def reduce_issue(issue):
+    """
+    Boil an issue from the API down to what the statistics use. The activity
+    is walked once here for when the issue was first resolved and the Sentry
+    names of everyone who resolved it, in order, so nothing downstream needs
+    to look at it again. Timestamps are left as Sentry wrote them so the
+    record can be cached as JSON
+    """
+    resolved_at = None
+    resolvers = []
+    for action in issue['activity']:
+        if action['type'] != 'set_resolved':
+            continue
+        if resolved_at is None:
+            resolved_at = action['dateCreated']
+        if action['user'] and action['user']['name'] not in resolvers:
+            resolvers.append(action['user']['name'])
+    return {
+        'id'            : issue['id'],
+        'count'         : issue['count'],
+        'first_seen'    : issue['firstSeen'],
+        'last_seen'     : issue['lastSeen'],
+        'project'       : issue['project']['name'],
+        'url'           : issue['permalink'],
+        'resolved_at'   : resolved_at,
+        'resolvers'     : resolvers,
+    }
 
-    session = create_session(config['sentry']['username'], config['sentry']['password'], config['sentry']['url'])
-    all_issues = [get_resolved_issues(config, session, project) for project in config['sentry']['projects']]
-    all_issues = [issue for group in all_issues for issue in group]
-    in_period = [issue for issue in all_issues if _resolved_between(issue, start, end)]
-    formatted = [format_issue(issue, config['users']) for issue in in_period]
-    by_user = {user.name: get_user_statistics(formatted, user) for user in config['users']}
+def _parse_record(record):
+    return dict(record,
+        first_seen  = dashi.timestamp.parse(record['first_seen']),
+        last_seen   = dashi.timestamp.parse(record['last_seen']),
+        resolved_at = dashi.timestamp.parse(record['resolved_at']) if record['resolved_at'] else None,
+    )
+
+def _resolver(record, aliases):
+    "The first person to resolve the issue that we know, like _get_resolved_by used to find"
+    for name in record['resolvers']:
+        user = aliases.get(name)
+        if user is not None:
+            return user
+    return None
+
+def summarise(config, records, start, end):
+    """
+    Group the issues resolved between start and end by who resolved them in
+    a single pass, so the cost doesn't depend on the number of users
+    """
+    aliases = config['aliases']
+    in_period = 0
+    by_resolver = {}
+    for record in records:
+        resolved_at = record['resolved_at']
+        if resolved_at is None or not end > resolved_at > start:
+            continue
+        in_period += 1
+        user = _resolver(record, aliases)
+        if user is not None:
+            by_resolver.setdefault(user, []).append(format_issue(record, user))
     return {
-        "issue_count"   : len(in_period),
-        "by_user"       : by_user,
+        "issue_count"   : in_period,
+        "by_user"       : {user.name: get_user_statistics(by_resolver.get(user, []), in_period) for user in config['users']},
     }
 
-def format_issue(issue, users):
+def format_issue(record, resolved_by):
     return {
-        "count"         : issue['count'],
-        "first_seen"    : dateutil.parser.parse(issue['firstSeen']),
-        "last_seen"     : dateutil.parser.parse(issue['lastSeen']),
-        "project"       : issue['project']['name'],
-        "resolved_by"   : _get_resolved_by(issue, users),
-        "url"           : issue['permalink'],
+        "count"         : record['count'],
+        "first_seen"    : record['first_seen'],
+        "last_seen"     : record['last_seen'],
+        "project"       : record['project'],
+        "resolved_by"   : resolved_by,
+        "url"           : record['url'],
     }
 
-def get_user_statistics(issues, user):
+def get_user_statistics(my_issues, issue_count):
     def _get_key(issue):
         return "{}:{}".format(issue['project'], issue['last_seen'].isoformat())
 
-    my_issues = [issue for issue in issues if issue['resolved_by'] == user]
     return {
         'count'         : len(my_issues),
         'issues'        : sorted(my_issues, key=_get_key),
-        'percentage'    : get_percentage(issues, my_issues),
+        'percentage'    : get_percentage(issue_count, len(my_issues)),
     }
 
-def get_percentage(issues, my_issues):
-    return round(len(my_issues) / float(len(issues)), 2) * 100
+def get_percentage(issue_count, my_count):
+    return round(my_count / float(issue_count), 2) * 100 if issue_count else 0
 
 def _log_request(request):
     LOGGER.debug("--- Request ---")
@@ -59,10 +147,15 @@ def _log_response(response):
     LOGGER.debug(" ")
     #LOGGER.debug(response.text)
 
-def create_session(username, password, url):
+def create_session(username, password, url, cache, concurrency=DEFAULT_CONCURRENCY):
     login_url = url + '/auth/login/'
-    session = requests.Session()
-    response = session.get(login_url)
+    session = dashi.httpcache.CachedSession(cache)
+    # Keep one connection alive per worker so concurrent requests don't have to reconnect
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # Logging in goes straight to the server, the cache would lose the CSRF cookie
+    response = session.send(session.prepare_request(requests.Request('GET', login_url)))
     assert response.ok
 
     payload = {
@@ -78,54 +171,75 @@ def create_session(username, password, url):
 
     return session
 
-def get_resolved_issues(config, session, project):
-    url = '{}/groups/?query=is%3Aresolved&limit=100&statsPeriod=14d'.format(project['url'])
-    request = requests.Request('GET', url)
-    prepared = session.prepare_request(request)
-    response = session.send(prepared)
-    assert response.ok
-    data = response.json()
-
+def _get(session, url):
+    backoff = 1
+    while backoff < 30:
+        response = session.get(url)
+        if response.status_code == 429:
+            LOGGER.debug("Being throttled GETing %s, waiting %s seconds", url, backoff)
+            time.sleep(backoff)
+            backoff = backoff * 1.5
+        elif response.ok:
+            return response
+        else:
+            raise Exception("Failed to get {}: {} {}".format(url, response.status_code, response.text))
+    raise Exception("Giving up on {}, too throttled".format(url))
+
+def request(session, url):
+    return _get(session, url).json()
+
+def request_all(session, url):
+    "Follow Sentry's Link header cursors until there are no more results"
     results = []
-    LOGGER.debug("Getting %s individual issues for %s", len(data), project)
-    for issue in data:
-        issue_url = '{}/api/0/groups/{}/'.format(config['sentry']['url'], issue['id'])
-        response = session.get(issue_url)
-        assert response.ok
-        results.append(response.json())
+    while url:
+        response = _get(session, url)
+        results += response.json()
+        link = response.links.get('next')
+        url = link['url'] if link and link.get('results') == 'true' else None
     return results
 
-def _get_resolved_datetime(issue):
-    for action in issue['activity']:
-        created = dateutil.parser.parse(action['dateCreated'])
-        if action['type'] == 'set_resolved':
-            return created
-
-def _resolved_between(issue, start, end):
-    resolved = _get_resolved_datetime(issue)
-    return resolved and end > resolved > start
-
-def _get_resolved_by(issue, users):
-    for action in issue['activity']:
-        #created = dateutil.parser.parse(action['dateCreated'])
-        if action['type'] == 'set_resolved':
-            for user in users:
-                if action['user'] and action['user']['name'] in user.aliases:
-                    return user
-    return None
-
-def _resolved_by(issue, user):
-    for action in issue['activity']:
-        #created = dateutil.parser.parse(action['dateCreated'])
-        if all([
-            action['type'] == 'set_resolved',
-            action['user']['name'] in user.aliases if action['user'] else False,
-            ]):
-            return True
-    return False
-
-def _get_resolved_between(issues, start, end):
-    return [issue for issue in issues if _resolved_between(issue, start, end)]
-
-def _get_resolved_between_by(issues, start, end, user):
-    return [issue for issue in issues if _resolved_between(issue, start, end) and _resolved_by(issue, user)]
+def cache_path(config, group_id):
+    root = config.get('paths', {}).get('sentry', os.path.join(os.environ['HOME'], '.dashi', 'sentry'))
+    return os.path.join(root, '{}.json'.format(group_id))
+
+def _read_cached_issue(path, last_seen):
+    try:
+        with open(path, 'r') as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        LOGGER.warning("Ignoring unreadable Sentry cache entry %s: %s", path, e)
+        return None
+    if cached['lastSeen'] != last_seen:
+        return None
+    # Entries written before issues were reduced hold the whole issue
+    return cached['record'] if 'record' in cached else reduce_issue(cached['issue'])
+
+def _write_cached_issue(path, last_seen, record):
+    with dashi.json.atomic_write(path) as f:
+        json.dump({'lastSeen': last_seen, 'record': record}, f)
+
+def get_issue(config, session, listed):
+    """
+    Get the reduced record for a group from the listing. A group that has
+    not been seen again since we last fetched it can't have changed so we
+    use the record on disk instead of asking Sentry again
+    """
+    path = cache_path(config, listed['id'])
+    record = _read_cached_issue(path, listed['lastSeen'])
+    if record is None:
+        record = reduce_issue(request(session, '{}/api/0/groups/{}/'.format(config['sentry']['url'], listed['id'])))
+        _write_cached_issue(path, listed['lastSeen'], record)
+    return _parse_record(record)
+
+def get_resolved_issues(config, session, executor):
+    urls = ['{}/groups/?query=is%3Aresolved&limit=100&statsPeriod=14d'.format(project['url'])
+        for project in config['sentry']['projects']]
+    listings = list(executor.map(lambda url: request_all(session, url), urls))
+
+    listed = []
+    for project, data in zip(config['sentry']['projects'], listings):
+        LOGGER.debug("Getting %s individual issues for %s", len(data), project)
+        listed += data
+    return list(executor.map(lambda issue: get_issue(config, session, issue), listed))
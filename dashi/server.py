@@ -1,17 +1,125 @@
+import datetime
+import gzip
+import logging
+import multiprocessing
+import threading
+
 import flask
+import gunicorn.app.base
 
 import dashi.api
-import pygal
+import dashi.config
+import dashi.time
+
+LOGGER = logging.getLogger(__name__)
 
+DEFAULT_BIND = '0.0.0.0:5000'
+DEFAULT_THREADS = 4
+# Finished weeks are never rendered again so browsers and CDNs can keep them
+ARCHIVE_MAX_AGE = 365 * 24 * 60 * 60
+CURRENT_MAX_AGE = 5 * 60
+COMPRESSIBLE = ('application/javascript', 'application/json', 'image/svg+xml', 'text/css', 'text/html', 'text/plain')
+MINIMUM_COMPRESS_SIZE = 512
+COMPRESSED_ENTRIES = 256
 
-def create_app():
+# Compressed bodies by ETag so the same chart or page isn't compressed for every viewer
+_COMPRESSED = {}
+_COMPRESSED_LOCK = threading.Lock()
+
+def create_app(config=None):
     app = flask.Flask(__name__, static_url_path='')
+    app.config['DASHI'] = config or dashi.config.parse()
 
     app.register_blueprint(dashi.api.blueprint)
+    app.add_url_rule('/<week>/<page>', 'archive', _archive_page)
+    app.after_request(_compress)
 
     return app
 
+def preload(app):
+    "Compile every template up front so no worker pays for it on its first request"
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    return app
+
+def _is_archived(week):
+    "Weeks before the one the generator is currently writing won't change again"
+    _, current = dashi.time.get_checkpoint(datetime.datetime.utcnow() - datetime.timedelta(days=7))
+    return week < current.date().isoformat()
+
+def _archive_page(week, page):
+    output = flask.current_app.config['DASHI']['paths']['output']
+    response = flask.send_from_directory(output, '{}/{}'.format(week, page))
+    response.cache_control.no_cache = None
+    if _is_archived(week):
+        response.cache_control.public = True
+        response.cache_control.max_age = ARCHIVE_MAX_AGE
+        response.headers['Cache-Control'] += ', immutable'
+    else:
+        response.cache_control.max_age = CURRENT_MAX_AGE
+    return response
+
+def _compress(response):
+    if any([
+        'gzip' not in flask.request.headers.get('Accept-Encoding', ''),
+        response.status_code != 200,
+        response.mimetype not in COMPRESSIBLE,
+        'Content-Encoding' in response.headers,
+        ]):
+        return response
+    # Files are sent straight from disk by default, read them so they can be compressed
+    response.direct_passthrough = False
+    data = response.get_data()
+    if len(data) < MINIMUM_COMPRESS_SIZE:
+        return response
+    response.set_data(_gzip(response.get_etag()[0], data))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def _gzip(etag, data):
+    if etag is None:
+        return gzip.compress(data, compresslevel=6)
+    with _COMPRESSED_LOCK:
+        compressed = _COMPRESSED.get(etag)
+    if compressed is None:
+        compressed = gzip.compress(data, compresslevel=6)
+        with _COMPRESSED_LOCK:
+            if len(_COMPRESSED) >= COMPRESSED_ENTRIES:
+                _COMPRESSED.clear()
+            _COMPRESSED[etag] = compressed
+    return compressed
+
+class Application(gunicorn.app.base.BaseApplication): # pylint: disable=abstract-method
+    """
+    Serve the app with gunicorn. The app is created once in the master and
+    the workers are forked from it so each starts with everything loaded
+    """
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.app
+
+def serve(config=None, bind=None, workers=None, threads=None):
+    config = config or dashi.config.parse()
+    options = config.get('server', {})
+    app = preload(create_app(config))
+    settings = {
+        'bind'          : bind or options.get('bind', DEFAULT_BIND),
+        'workers'       : workers or options.get('workers', multiprocessing.cpu_count()),
+        'threads'       : threads or options.get('threads', DEFAULT_THREADS),
+        'worker_class'  : 'gthread',
+        'preload_app'   : True,
+    }
+    LOGGER.info("Serving on %s with %d workers of %d threads", settings['bind'], settings['workers'], settings['threads'])
+    Application(app, settings).run()
+
 def run():
-    app = create_app()
-    app.config['DEBUG'] = True
-    app.run('0.0.0.0', 5000)
+    serve()
@@ -0,0 +1,27 @@
+import datetime
+import functools
+
+import dateutil.parser
+
+# Big enough to hold every distinct timestamp one collection run sees
+CACHE_SIZE = 64 * 1024
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse(value):
+    """
+    Parse a timestamp string. Everything we get from git, Sentry, the
+    database and our own caches is ISO 8601, which datetime can parse
+    directly and far faster than dateutil. Anything else still goes to
+    dateutil. The same strings come up again and again, in Sentry activity
+    and cached data in particular, so results are remembered
+    """
+    try:
+        return _from_iso(value)
+    except ValueError:
+        return dateutil.parser.parse(value)
+
+def _from_iso(value):
+    # fromisoformat only understands a trailing Z from Python 3.11 on
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(value)
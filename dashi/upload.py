@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
+import concurrent.futures
+import hashlib
+import json
 import logging
 import os
 
 import boto3
+import botocore.exceptions
+
+import dashi.json
 
 CONTENT_TYPES = {
-    '.json' : 'appication/json',
+    '.json' : 'application/json',
     '.html' : 'text/html',
     '.css'  : 'text/css',
     '.js'   : 'application/javascript',
@@ -15,6 +21,10 @@ CONTENT_TYPES = {
     '.jpg'  : 'image/jpg',
 }
 
+DEFAULT_CONCURRENCY = 8
+CHUNK_SIZE = 1024 * 1024
+# The MD5 of every key already in each bucket, so unchanged files are never sent again
+MANIFEST = '.dashi-upload-manifest.json'
 
 LOGGER = logging.getLogger(__name__)
 
@@ -26,18 +36,76 @@ def _get_content_type(source):
     return 'application/octet-stream'
 
 
-def go(config, env):
-    s3 = boto3.resource('s3', region_name='us-west-2')
-    LOGGER.info("Uploading to S3 bucket %s", config['upload']['bucket'])
-    bucket = s3.Bucket(config['upload']['bucket'])
-    for _, outputpath in env.output():
-        LOGGER.info("Uploading %s", outputpath)
-        fullpath = os.path.join(env.output_path, outputpath)
-        with open(fullpath, 'rb') as f:
-            content = f.read()
-            bucket.put_object(
-                Key=outputpath,
-                Body=content,
-                ACL='public-read',
-                ContentType=_get_content_type(outputpath),
-                )
+def _upload_args(key):
+    "Gzipped copies go up as the type they hold with a Content-Encoding so browsers decode them"
+    args = {'ACL': 'public-read'}
+    if key.endswith('.gz'):
+        args['ContentEncoding'] = 'gzip'
+        key = key[:-len('.gz')]
+    args['ContentType'] = _get_content_type(key)
+    return args
+
+def _md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_manifest(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        LOGGER.warning("Ignoring unreadable upload manifest %s: %s", path, e)
+        return {}
+
+def _save_manifest(path, manifest):
+    with dashi.json.atomic_write(path) as f:
+        json.dump(manifest, f, sort_keys=True, indent=2)
+
+def _remote_md5(client, bucket, key):
+    try:
+        response = client.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    # Only single part uploads have the MD5 as their ETag, which is fine since
+    # a multipart ETag just won't match and we upload again
+    return response['ETag'].strip('"')
+
+def _sync(client, bucket, uploaded, fullpath, key):
+    "Upload the file unless S3 already has this content. Returns the file's MD5 and whether it was sent"
+    digest = _md5(fullpath)
+    if uploaded.get(key) == digest:
+        return digest, False
+    if key not in uploaded and _remote_md5(client, bucket, key) == digest:
+        return digest, False
+    LOGGER.info("Uploading %s", key)
+    # upload_file streams from disk and switches to multipart for large files
+    client.upload_file(fullpath, bucket, key, ExtraArgs=_upload_args(key))
+    return digest, True
+
+def go(config, env, client=None):
+    bucket = config['upload']['bucket']
+    concurrency = config['upload'].get('concurrency', DEFAULT_CONCURRENCY)
+    client = client or boto3.client('s3', region_name=config['upload'].get('region', 'us-west-2'))
+    manifest_path = os.path.join(env.output_path, MANIFEST)
+    manifest = _load_manifest(manifest_path)
+    uploaded = manifest.setdefault(bucket, {})
+    LOGGER.info("Uploading to S3 bucket %s", bucket)
+
+    keys = [outputpath for _, outputpath in env.output()]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda key: _sync(client, bucket, uploaded, os.path.join(env.output_path, key), key), keys))
+
+    sent = 0
+    for key, (digest, was_sent) in zip(keys, results):
+        uploaded[key] = digest
+        sent += was_sent
+    _save_manifest(manifest_path, manifest)
+    LOGGER.info("Uploaded %d files, %d were unchanged", sent, len(keys) - sent)
@@ -79,10 +79,16 @@ def main():
             install_requires    = [
                 'boto3==1.1.4',
                 'Flask==0.10.1',
+                'gunicorn==19.3.0',
                 'Jinja2==2.7.3',
+                'numpy==1.21.6',
+                'pygal==2.0.0',
                 'PyYAML==3.11',
             ],
             extras_require       = {
+                'fast'           : [
+                    'orjson==3.8.3',
+                ],
                 'develop'        : [
                     'pytest==2.6.4',
                     'pylint==1.4.3',
@@ -96,6 +102,7 @@ def main():
             data_files           = get_data_files(),
             scripts = [
                 "bin/dashi",
+                "bin/serve",
             ],
             include_package_data = True,
         )